@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import subprocess
+import tempfile
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_BINARY = getattr(settings, 'FFMPEG_BINARY', 'ffmpeg')
+# 使用的编码格式，h264 / hevc / av1
+VIDEO_ENCODER_FAMILY = getattr(settings, 'VIDEO_ENCODER_FAMILY', 'h264')
+# 强制使用指定名称的编码配置，如'libx264'，为None时按优先级自动选择
+VIDEO_ENCODER = getattr(settings, 'VIDEO_ENCODER', None)
+# 编码器探测结果的缓存文件，同一节点的各worker进程共用，必须位于本地文件系统
+VIDEO_ENCODER_CACHE_PATH = getattr(settings, 'VIDEO_ENCODER_CACHE_PATH',
+                                   os.path.join(tempfile.gettempdir(), 'video_encoders.json'))
+
+
+class EncoderProfile:
+    """
+    一个编码器及其预设参数
+
+    :param name: 编码配置名称，与ffmpeg编码器名称相同
+    :param hwaccel: 配合使用的硬件解码方式，为None时使用软件解码
+    :param preset: 编码速度预设
+    :param quality: 未指定码率时使用的恒定质量参数
+    :param quality_option: 恒定质量参数的名称，软件编码器为crf，nvenc为cq
+    :param threads: 编码线程数，0表示由ffmpeg自动决定
+    :param options: 其它编码参数
+    """
+
+    def __init__(self, name: str, family: str, hwaccel: Optional[str] = None, preset: Optional[str] = None,
+                 quality: Optional[int] = None, quality_option: str = 'crf', threads: Optional[int] = None,
+                 options: Optional[Dict] = None):
+        self.name = name
+        self.family = family
+        self.hwaccel = hwaccel
+        self.preset = preset
+        self.quality = quality
+        self.quality_option = quality_option
+        self.threads = threads
+        self.options = options or {}
+
+    @property
+    def is_hardware(self) -> bool:
+        return self.hwaccel is not None
+
+    def input_kwargs(self) -> dict:
+        """传给ffmpeg.input的参数"""
+        return {'hwaccel': self.hwaccel} if self.hwaccel else {}
+
+    def output_kwargs(self, bitrates: Sequence[str] = ()) -> dict:
+        """
+        传给ffmpeg.output的视频编码参数
+
+        :param bitrates: 各路输出视频流的码率，只有一路时设置b:v，多路时依次设置b:v:0, b:v:1...，为空时使用恒定质量
+        """
+        kwargs = {'c:v': self.name, **self.options}
+        if self.preset is not None:
+            kwargs['preset'] = self.preset
+        if self.threads is not None:
+            kwargs['threads'] = self.threads
+        if len(bitrates) == 1:
+            kwargs['b:v'] = bitrates[0]
+        elif bitrates:
+            for i, bitrate in enumerate(bitrates):
+                kwargs[f'b:v:{i}'] = bitrate
+        elif self.quality is not None:
+            kwargs[self.quality_option] = self.quality
+        return kwargs
+
+    def __repr__(self):
+        return f'<EncoderProfile {self.name}>'
+
+
+# 各编码格式的候选编码配置，按优先级从高到低排列，硬件编码器在前，软件编码器兜底
+DEFAULT_ENCODER_PROFILES = {
+    'h264': [
+        EncoderProfile('h264_nvenc', 'h264', hwaccel='cuda', preset='p4', quality=23, quality_option='cq'),
+        EncoderProfile('libx264', 'h264', preset='veryfast', quality=23, threads=0),
+    ],
+    'hevc': [
+        EncoderProfile('hevc_nvenc', 'hevc', hwaccel='cuda', preset='p4', quality=28, quality_option='cq'),
+        EncoderProfile('libx265', 'hevc', preset='fast', quality=28, threads=0),
+    ],
+    'av1': [
+        EncoderProfile('av1_nvenc', 'av1', hwaccel='cuda', preset='p4', quality=30, quality_option='cq'),
+        EncoderProfile('libsvtav1', 'av1', preset='8', quality=35),
+    ],
+}
+ENCODER_PROFILES = getattr(settings, 'VIDEO_ENCODER_PROFILES', DEFAULT_ENCODER_PROFILES)
+
+
+def _run_ffmpeg(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([FFMPEG_BINARY, '-hide_banner', *args], capture_output=True, text=True, timeout=30)
+
+
+def _list_encoders() -> List[str]:
+    # 输出格式为" V....D libx264              libx264 H.264 / AVC ..."，分隔线之后为编码器列表
+    lines = _run_ffmpeg('-encoders').stdout.splitlines()
+    start = next((i + 1 for i, line in enumerate(lines) if line.strip().startswith('---')), len(lines))
+    return [line.split()[1] for line in lines[start:] if len(line.split()) > 1]
+
+
+def _list_hwaccels() -> List[str]:
+    lines = _run_ffmpeg('-hwaccels').stdout.splitlines()
+    return [line.strip() for line in lines[1:] if line.strip()]
+
+
+def _can_encode(profile: EncoderProfile) -> bool:
+    """
+    实际编码一小段测试画面，确认编码器可用
+
+    ffmpeg编译时启用了硬件编码器即会出现在编码器列表中，但所在机器可能没有对应的显卡或驱动，只能通过试编码判断
+    """
+    result = _run_ffmpeg('-f', 'lavfi', '-i', 'color=black:s=256x144:d=0.1', '-c:v', profile.name,
+                         '-f', 'null', '-')
+    return result.returncode == 0
+
+
+def _probe_available() -> Optional[Dict[str, List[str]]]:
+    """实际探测可用的编码配置，:return: 各编码格式可用的编码配置名称，ffmpeg无法执行时返回None"""
+    try:
+        encoders = set(_list_encoders())
+        hwaccels = set(_list_hwaccels())
+    except (OSError, subprocess.SubprocessError):
+        logger.exception('probe ffmpeg encoders failed')
+        return None
+    available = {}
+    for family, profiles in ENCODER_PROFILES.items():
+        for profile in profiles:
+            if profile.name not in encoders:
+                continue
+            if profile.is_hardware and (profile.hwaccel not in hwaccels or not _can_encode(profile)):
+                continue
+            available.setdefault(family, []).append(profile.name)
+    logger.info('available encoders: %s', available)
+    return available
+
+
+def _read_encoder_cache() -> Optional[Dict[str, List[str]]]:
+    try:
+        with open(VIDEO_ENCODER_CACHE_PATH, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # 编码配置或ffmpeg发生变化后缓存失效
+    if cache.get('ffmpeg') != FFMPEG_BINARY or cache.get('profiles') != _get_profile_names():
+        return None
+    return cache.get('available')
+
+
+def _write_encoder_cache(available: Dict[str, List[str]]):
+    tmp_path = f'{VIDEO_ENCODER_CACHE_PATH}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'ffmpeg': FFMPEG_BINARY, 'profiles': _get_profile_names(), 'available': available}, f)
+    os.replace(tmp_path, VIDEO_ENCODER_CACHE_PATH)
+
+
+def _get_profile_names() -> Dict[str, List[str]]:
+    return {family: [profile.name for profile in profiles] for family, profiles in ENCODER_PROFILES.items()}
+
+
+def load_available_encoders(refresh: bool = False) -> Optional[Dict[str, List[str]]]:
+    """
+    读取本节点可用的编码配置名称，没有缓存时探测一次并写入缓存文件
+
+    试编码会占用显卡的编码会话，多个进程同时探测可能超出NVENC的会话数限制而误判为不可用，
+    因此通过文件锁保证同一节点同一时刻只有一个进程在探测，其余进程等待后直接读取结果；探测失败时不写缓存
+    :param refresh: 忽略已有的缓存重新探测，worker启动时由主进程调用一次
+    """
+    if fcntl is None:
+        return _probe_available()
+    os.makedirs(os.path.dirname(VIDEO_ENCODER_CACHE_PATH), exist_ok=True)
+    with open(VIDEO_ENCODER_CACHE_PATH + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        available = None if refresh else _read_encoder_cache()
+        if available is None:
+            available = _probe_available()
+            if available is not None:
+                _write_encoder_cache(available)
+        return available
+
+
+@lru_cache(maxsize=None)
+def probe_encoders() -> Dict[str, List[EncoderProfile]]:
+    """
+    当前机器可用的编码配置，按编码格式分组，结果在进程内缓存
+
+    worker主进程启动时探测一次并写入缓存文件，各子进程读取该文件，不再各自试编码
+    """
+    available = load_available_encoders() or {}
+    return {family: [profile for profile in profiles if profile.name in available.get(family, [])]
+            for family, profiles in ENCODER_PROFILES.items() if available.get(family)}
+
+
+def select_encoder(family: str = VIDEO_ENCODER_FAMILY, name: Optional[str] = VIDEO_ENCODER) -> EncoderProfile:
+    """
+    选择当前机器上指定编码格式最优的编码配置
+
+    :param name: 指定编码配置名称，不可用时报错
+    """
+    profiles = probe_encoders().get(family, [])
+    if name is not None:
+        profiles = [profile for profile in profiles if profile.name == name]
+    if not profiles:
+        raise RuntimeError(f'no available encoder for {family}' + (f' named {name}' if name else ''))
+    return profiles[0]
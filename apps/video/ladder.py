@@ -0,0 +1,57 @@
+from typing import List, Sequence, Tuple
+
+from django.conf import settings
+
+from apps.video import transcode
+from apps.video.encoders import select_encoder
+
+# 分辨率阶梯的选择策略，fixed为所有视频使用VIDEO_LADDER，content_aware为根据画面复杂度调整各级码率
+VIDEO_LADDER_POLICY = getattr(settings, 'VIDEO_LADDER_POLICY', 'content_aware')
+# 基准分辨率阶梯，依次为(分辨率, 视频码率)
+VIDEO_LADDER = getattr(settings, 'VIDEO_LADDER', transcode.DEFAULT_LADDER)
+# 复杂度为此值(640x360恒定质量试编码的码率)时使用基准码率，复杂度更高或更低时按比例调整
+COMPLEXITY_REFERENCE_BITRATE = getattr(settings, 'VIDEO_COMPLEXITY_REFERENCE_BITRATE', 800 * 1000)
+# 码率调整比例的范围，避免极端的采样结果使码率过低或过高
+LADDER_SCALE_RANGE = getattr(settings, 'VIDEO_LADDER_SCALE_RANGE', (0.4, 1.5))
+# 试编码固定使用软件编码器，不同编码器在相同质量参数下的码率不可比，基准值只对该编码器有效
+COMPLEXITY_ENCODER = getattr(settings, 'VIDEO_COMPLEXITY_ENCODER', 'libx264')
+
+
+def format_bitrate(bitrate: float) -> str:
+    """按100k取整，如3624000 -> '3600k'"""
+    return f'{max(int(round(bitrate / 100000)), 1) * 100}k'
+
+
+def scale_ladder(ladder: Sequence[Tuple[str, str]], scale: float) -> List[Tuple[str, str]]:
+    return [(resolution, format_bitrate(transcode.parse_bitrate(bitrate) * scale)) for resolution, bitrate in ladder]
+
+
+def drop_upscaled_rungs(ladder: Sequence[Tuple[str, str]], probe: dict) -> List[Tuple[str, str]]:
+    """去掉高于源视频分辨率的级别，放大不会增加细节，只会浪费码率，最低一级始终保留"""
+    source_pixels = probe['width'] * probe['height']
+    rungs = sorted(ladder, key=lambda rung: transcode.get_pixel_count(rung[0]), reverse=True)
+    kept = [rung for rung in rungs if transcode.get_pixel_count(rung[0]) <= source_pixels]
+    return kept or rungs[-1:]
+
+
+def choose_ladder(input_path: str, probe: dict, work_dir: str) -> dict:
+    """
+    按VIDEO_LADDER_POLICY为视频选择分辨率阶梯
+
+    :return: 策略policy、复杂度complexity(fixed策略下为None)及选定的阶梯rungs，可直接保存到Video.metadata
+    """
+    ladder = drop_upscaled_rungs(VIDEO_LADDER, probe)
+    if VIDEO_LADDER_POLICY != 'content_aware':
+        return {'policy': VIDEO_LADDER_POLICY, 'complexity': None, 'rungs': [list(rung) for rung in ladder]}
+    try:
+        encoder = select_encoder(name=COMPLEXITY_ENCODER)
+    except RuntimeError:
+        encoder = None
+    complexity = transcode.measure_complexity(input_path, probe['duration'], work_dir, encoder=encoder)
+    low, high = LADDER_SCALE_RANGE
+    scale = min(max(complexity / COMPLEXITY_REFERENCE_BITRATE, low), high)
+    return {
+        'policy': VIDEO_LADDER_POLICY,
+        'complexity': int(complexity),
+        'rungs': [list(rung) for rung in scale_ladder(ladder, scale)],
+    }
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management import BaseCommand
+
+from service import multipart_file_upload
+from service.multipart_file_upload import MultipartFileUploadService
+
+GB = 1024 * 1024 * 1024
+MB = 1024 * 1024
+
+
+def generate_chunks(chunk_dir: str, file_hash: str, total_size: int, chunk_size: int):
+    """生成合成的切片文件，内容为重复的随机数据块"""
+    os.makedirs(chunk_dir)
+    block = os.urandom(MB)
+    index = 0
+    remaining = total_size
+    while remaining > 0:
+        size = min(chunk_size, remaining)
+        with open(os.path.join(chunk_dir, f'{file_hash}-{index}'), 'wb') as f:
+            written = 0
+            while written < size:
+                written += f.write(block[:min(MB, size - written)])
+        remaining -= size
+        index += 1
+
+
+class Command(BaseCommand):
+    help = '对比内核态拷贝与用户态读写两种切片合并方式的吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 2, 5, 10], help='合成文件大小，单位GB')
+        parser.add_argument('--chunk-size', type=int, default=10, help='切片大小，单位MB')
+        parser.add_argument('--dir', type=str, default=None, help='测试目录，默认在TMP_UPLOAD_ROOT下创建，应与线上切片目录位于同一文件系统')
+
+    def handle(self, *args, **options):
+        work_dir = tempfile.mkdtemp(prefix='bench_merge_', dir=options['dir'] or multipart_file_upload.TMP_UPLOAD_ROOT)
+        # 切片及合并结果均写入测试目录，不影响正常上传
+        multipart_file_upload.TMP_UPLOAD_ROOT = work_dir
+        try:
+            for size_gb in options['sizes']:
+                for use_kernel_copy in (True, False):
+                    file_hash = f'bench{size_gb}g{int(use_kernel_copy)}'
+                    generate_chunks(os.path.join(work_dir, f'chunkDir_{file_hash}'), file_hash, size_gb * GB,
+                                    options['chunk_size'] * MB)
+                    service = MultipartFileUploadService()
+                    service.use_kernel_copy = use_kernel_copy
+                    # 测试用的哈希不是真实的MD5，且只测量合并本身的耗时
+                    service.verify_file_hash = False
+                    start = time.perf_counter()
+                    file_path = service.merge_file_chunk(file_hash, '.bin')
+                    cost = time.perf_counter() - start
+                    os.remove(file_path)
+                    self.stdout.write('{0:>3}GB {1:<6} {2:8.2f}s {3:10.1f}MB/s'.format(
+                        size_gb, 'kernel' if use_kernel_copy else 'user', cost, size_gb * GB / MB / cost))
+        finally:
+            shutil.rmtree(work_dir)
@@ -1,221 +1,232 @@
-from django.conf import settings
-from django.core.management.base import BaseCommand
-from apps.video.models import Video, StatusEnum
-
-import argparse
+import csv
+import hashlib
+import json
 import os
-import shutil
 import time
-from datetime import datetime
-from pathlib import Path
-from typing import Sequence
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-import ffmpeg
-from celery import shared_task
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
-from defog.defog import DefogModel
+from apps.video import tasks
+from apps.video.models import MediaObject, StatusEnum, Video
+from apps.video.progress import get_progress
+from apps.video.service import VideoUploadService
 
 MEDIA_ROOT = settings.MEDIA_ROOT
+# 扫描目录时导入的视频文件扩展名
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.mkv', '.avi', '.flv', '.ts', '.m4v', '.wmv', '.mpg', '.mpeg')
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
 
 
-def extract_ext(file_path: str):
-    if "." not in file_path:
-        raise ValueError("there is not a ext name in the file path")
+def compute_file_hash(file_path: str) -> str:
+    """与上传时使用的文件哈希一致，为整个文件的MD5，hashlib在计算大块数据时会释放GIL，可多线程并行"""
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
 
-    return file_path.rsplit(".", 1)
 
+def is_finished(video: Video) -> bool:
+    """逐步发布时视频在最低分辨率完成后即为FINISHED，源视频的全部分辨率转码完成后才算导入完成"""
+    return video.status == StatusEnum.FINISHED.value and MediaObject.objects.filter(
+        fileHash=video.fileHash, status=StatusEnum.FINISHED.value).exists()
 
-def resolution_conversion_new(input_path: str,
-                              target_resolution_list: Sequence[str],
-                              target_bv_list: Sequence[str]):
-    file_path_, ext = extract_ext(input_path)
-    output_list = []
-    output_path_list = []
 
-    # 检查音频流是否存在
-    probe = ffmpeg.probe(input_path)
-    has_audio = any(
-        stream.get('codec_type') == 'audio' for stream in probe['streams'])
+def is_failed(video: Video) -> bool:
+    # 已部分发布的视频转码失败时状态仍为FINISHED，只记录任务失败
+    return video.status == StatusEnum.UNKNOWN.value or (video.metadata or {}).get('job', {}).get('stage') == 'failed'
 
-    for i, target_resolution in enumerate(target_resolution_list):
-        output_path = f'{file_path_}_{target_resolution}.{ext}'
-        print(output_path)
-        output_path_list.append(output_path)
-        input_ = ffmpeg.input(input_path, hwaccel='cuda')
-        video = input_.video.filter('scale', target_resolution).filter(
-            'setdar', '16/9')
 
-        if has_audio:
-            output = ffmpeg.output(input_.audio, video, output_path,
-                                   vcodec='h264_nvenc', b=target_bv_list[i])
-        else:
-            output = ffmpeg.output(video, output_path, vcodec='h264_nvenc',
-                                   b=target_bv_list[i])
-        output_list.append(output)
-
-    def try_run(tries: int = 4):
-        if tries > 0:
-            try:
-                ffmpeg.merge_outputs(*output_list).run(quiet=False)
-            except Exception as e:
-                print(f'Error: {e}, retrying... {tries - 1} tries left')
-                try_run(tries - 1)
-        else:
-            raise RuntimeError("Maximum retries reached, operation failed")
-
-    try_run()  # Start the recursive retries
-    return output_path_list
-
-
-def defog_video(input_path: str):
-    defog_model = DefogModel(input_path)
-    defog_model.video2image()
-    defog_model.inference()
-    defog_video_path = defog_model.image2video()
-    return defog_video_path
-
-
-def convert2dash(input_path_list: Sequence[str], mpd_path: str):
-    input_list = [ffmpeg.input(file_path, hwaccel='cuda') for file_path in
-                  input_path_list]
-    ffmpeg.output(*input_list, mpd_path, vcodec='h264_nvenc', acodec="aac",
-                  seg_duration=5,
-                  adaptation_sets="id=0,streams=v id=1,streams=a",
-                  f="dash").run(quiet=False)
-
-
-def generate_poster_path(video_path: str, file_hash: str):
-    parent_dir = Path(video_path).parent
-    poster_path = os.path.join(parent_dir, f'{file_hash}_poster.png')
-    return poster_path
-
-
-def video_process(input_path: str, mpd_path: str, video_id: str):
-    # self.generate_video_poster(input_path, poster_path)
-    # todo step1 将原视频交给去雾模型进行演算
-    # step2 将去雾视频转换为其它分辨率，共3个分辨率以供选择(1920x1080, 1280x720, 640x360)
-    # multi_resolution_output = self.resolution_conversion(input_path, ['1920x1080', '1280x720', '640x360'])
-
-    try:
-        multi_resolution_output = resolution_conversion_new(input_path,
-                                                            ['1920x1080',
-                                                             '1280x720',
-                                                             '640x360'],
-                                                            ['8M', '4.5M',
-                                                             '1.5M'])
-        if_defog = False
-        if if_defog:
-            defog_video_path = defog_video(input_path)
-            multi_resolution_output_defog = resolution_conversion_new(
-                defog_video_path,
-                ['1920x1080', '1280x720', '640x360'],
-                ['8.1M', '4.6M', '1.6M'])
-            # step3 将原视频和去雾视频转为dash(异步)
-            convert2dash(
-                multi_resolution_output + multi_resolution_output_defog,
-                mpd_path)
-        else:
-            convert2dash(multi_resolution_output, mpd_path)
-        # 更新数据库状态
-        video = Video.objects.get(videoId=video_id)
-        video.status = StatusEnum.FINISHED.value
-        video.resolutionVersion = '1920x1080,1280x720,640x360'
-        video.save()
-    except Exception as e:
-        print(e)
-        video = Video.objects.get(videoId=video_id)
-        video.status = StatusEnum.UNKNOWN.value
-        video.save()
-
-
-def generate_video_path():
-    while True:
-        # 获取当前时间
-        now = datetime.now()
-
-        # 构建路径
-        video_path = os.path.join(
-            "/data/videos",
-            # "D:\\Project_Code\\video-site\\script",
-            str(now.year),
-            str(now.month).zfill(2),
-            str(now.day).zfill(2),
-            str(now.hour).zfill(2),
-            str(now.minute).zfill(2)
-        )
-
-        # 检查路径是否已存在
-        if not os.path.exists(video_path):
-            os.makedirs(video_path)
-            break
-
-    return video_path
-
-
-def move_video(video_path, folder_path):
-    # 移动文件
-    new_video_path = shutil.copy(video_path, folder_path)
-    return new_video_path
-
-
-def generate_mpd_path(video_path: str, file_hash: str):
-    parent_dir = Path(video_path).parent
-    dash_dir = os.path.join(parent_dir, f'dash_{file_hash}')
-    if not os.path.exists(dash_dir):
-        os.makedirs(dash_dir)
-    # mpd_path = os.path.join(dash_dir, "stream.mpd")
-    # ffmpeg进行dash分片时，最后一级的路径分隔符必须是'/'，即使windows平台也是如此，上面一行的写法在windows平台会出现问题，疑似为ffmpeg的bug
-    mpd_path = dash_dir + "/stream.mpd"
-    return mpd_path
-
-
-def generate_video_poster(video_path: str, poster_path: str):
-    probe = ffmpeg.probe(video_path)
-    video_duration = float(probe['format']['duration'])
-    if video_duration >= 60.0:  # 大于等于1分钟
-        time_point = "00:01:00"
-    else:  # 小于1分钟
-        time_point = "00:00:00"
-    try:
-        ffmpeg.input(video_path, ss=time_point).output(poster_path,
-                                                       vframes=1).run(
-            quiet=False)
-    except ffmpeg.Error as e:
-        print(
-            "An error occurred while generating the video poster: {0}".format(
-                e))
+class ImportState:
+    """
+    记录每个文件的导入状态，保存为json，重新执行命令时跳过已完成的文件
+
+    每个文件记录大小、修改时间、哈希、视频id和状态(queued / finished / failed)，
+    大小和修改时间不变的文件不重新计算哈希
+    """
+
+    def __init__(self, state_path: str):
+        self.state_path = state_path
+        self.items = {}
+        if os.path.exists(state_path):
+            with open(state_path, encoding='utf-8') as f:
+                self.items = json.load(f)
+
+    def get(self, source_path: str) -> dict:
+        stat = os.stat(source_path)
+        item = self.items.get(source_path)
+        if item is None or item.get('size') != stat.st_size or item.get('mtime') != stat.st_mtime_ns:
+            # 文件发生变化时重新导入
+            item = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            self.items[source_path] = item
+        return item
+
+    def update(self, source_path: str, **fields):
+        self.items[source_path].update(fields)
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.items, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_path)
 
 
 class Command(BaseCommand):
-    help = '手动上传视频后，使用此命令在命令行中处理'
+    help = '批量导入服务器上已有的视频文件并在后台转码，可重复执行，已完成的文件会被跳过'
 
     def add_arguments(self, parser):
-        parser.add_argument('path', type=str, help='视频路径')
-        parser.add_argument('course', type=str, help='course id')
+        parser.add_argument('path', type=str, help='视频文件、包含视频的目录(递归扫描)，或配合--manifest使用的清单文件')
+        parser.add_argument('course', type=str, help='course id，清单中未指定课程的文件使用此课程')
+        parser.add_argument('--manifest', action='store_true',
+                            help='path为清单文件，每行为"视频路径[,course id]"，相对路径相对于清单所在目录，#开头的行被忽略')
+        parser.add_argument('--state', type=str, default=None,
+                            help='导入状态文件的路径，默认按path存放在MEDIA_ROOT/imports下')
+        parser.add_argument('--hash-workers', type=int, default=4, help='并行计算文件哈希的线程数')
+        parser.add_argument('--max-inflight', type=int, default=4, help='同时处于入库、转码中的视频数上限')
+        parser.add_argument('--poll-interval', type=float, default=10, help='检查转码状态的间隔，单位秒')
+        parser.add_argument('--no-wait', action='store_true', help='全部投递后立即退出，不等待最后一批转码完成')
+        parser.add_argument('--stall-timeout', type=float, default=2 * 3600,
+                            help='视频的状态和转码进度超过此秒数没有变化时视为失败，释放其名额，为0时不检查')
 
     def handle(self, *args, **options):
-        source_path = options['path']
-        course_id = options['course']
-        folder_path = generate_video_path()
-        file_hash = str(int(time.time()))
-        folder_path = os.path.join(folder_path, file_hash + '.mp4')
-
-        target_path = move_video(source_path, folder_path)
-        poster_path = generate_poster_path(target_path, file_hash)
-        mpd_path = generate_mpd_path(target_path, file_hash)
-        video_id = 'vid_{}'.format(file_hash)
-
-        video_data = {
-            "videoId": video_id,
-            "videoName": os.path.basename(source_path),
-            "videoUrl": os.path.relpath(mpd_path, MEDIA_ROOT),
-            "coverImgUrl": os.path.relpath(poster_path, MEDIA_ROOT),
-            "courseId": course_id,
-            "status": StatusEnum.PROCESSING.value
-        }
-        new_video = Video.objects.create(**video_data)
-        print(new_video)
-
-        generate_video_poster(target_path, poster_path)
-        video_process(target_path, mpd_path, video_id)
-        # 这里可以访问模型和执行脚本逻辑
\ No newline at end of file
+        path = os.path.abspath(options['path'])
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist')
+        items = self.collect_items(path, options['course'], options['manifest'])
+        state_path = options['state'] or os.path.join(
+            MEDIA_ROOT, 'imports', f'{hashlib.md5(path.encode()).hexdigest()[:16]}.json')
+        state = ImportState(state_path)
+        self.stall_timeout = options['stall_timeout']
+        # 各视频最近一次观察到的状态快照及其发生变化的时间
+        self.activity = {}
+        self.stdout.write(f'{len(items)} files to import, state file: {state_path}')
+
+        self.hash_items(items, state, options['hash_workers'])
+        inflight = {}
+        for source_path, course_id in items:
+            item = state.get(source_path)
+            if item.get('status') == 'finished':
+                continue
+            while len(inflight) >= options['max_inflight']:
+                time.sleep(options['poll_interval'])
+                self.poll(inflight, state)
+            video_id = self.submit(source_path, course_id, item, state)
+            if state.items[source_path].get('status') == 'queued':
+                inflight[video_id] = source_path
+        while inflight and not options['no_wait']:
+            time.sleep(options['poll_interval'])
+            self.poll(inflight, state)
+
+        statuses = [state.items[source_path].get('status') for source_path, _ in items]
+        self.stdout.write(f'finished {statuses.count("finished")}, failed {statuses.count("failed")}, '
+                          f'in progress {statuses.count("queued")}')
+
+    def collect_items(self, path: str, course_id: str, is_manifest: bool):
+        """:return: [(源文件绝对路径, course id)]，同一文件只出现一次"""
+        if is_manifest:
+            base_dir = os.path.dirname(path)
+            items = []
+            with open(path, encoding='utf-8', newline='') as f:
+                for row in csv.reader(f):
+                    if not row or not row[0].strip() or row[0].lstrip().startswith('#'):
+                        continue
+                    file_course = row[1].strip() if len(row) > 1 and row[1].strip() else course_id
+                    items.append((os.path.abspath(os.path.join(base_dir, row[0].strip())), file_course))
+        elif os.path.isdir(path):
+            items = [(os.path.join(root, name), course_id)
+                     for root, _, names in os.walk(path) for name in names
+                     if name.lower().endswith(VIDEO_EXTENSIONS)]
+        else:
+            items = [(path, course_id)]
+        missing = [source_path for source_path, _ in items if not os.path.isfile(source_path)]
+        if missing:
+            raise CommandError(f'files not found: {missing}')
+        return sorted(dict(items).items())
+
+    def hash_items(self, items, state: ImportState, workers: int):
+        pending = [source_path for source_path, _ in items if 'hash' not in state.get(source_path)]
+        if not pending:
+            return
+        self.stdout.write(f'hashing {len(pending)} files with {workers} workers')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for source_path, file_hash in zip(pending, executor.map(compute_file_hash, pending)):
+                state.update(source_path, hash=file_hash)
+
+    def submit(self, source_path: str, course_id: str, item: dict, state: ImportState) -> str:
+        """
+        存入内容寻址存储、创建视频记录并投递入库任务
+
+        只为新建或转码失败的视频投递任务，已存在且仍在处理中的视频(如网页上传后正在转码，或其他状态文件导入的同一文件)
+        不重复入库，只记录其视频id并等待其完成
+        """
+        service = VideoUploadService()
+        file_hash = item['hash']
+        file_ext = os.path.splitext(source_path)[1].lower()
+        service.import_media_object(file_hash, source_path)
+
+        video = Video.objects.filter(fileHash=file_hash, courseId=course_id).first()
+        if video is None:
+            video_id = f'vid_{file_hash}_{uuid.uuid4().hex[:8]}'
+            _, mpd_path, poster_path = service.generate_video_paths(file_hash, file_ext, video_id)
+            video = Video.objects.create(
+                videoId=video_id,
+                videoName=os.path.basename(source_path),
+                videoUrl=os.path.relpath(mpd_path, MEDIA_ROOT),
+                coverImgUrl=os.path.relpath(poster_path, MEDIA_ROOT),
+                courseId=course_id,
+                fileHash=file_hash,
+                status=StatusEnum.UPLOADING.value,
+                metadata={'job': {'stage': 'queued'}},
+            )
+        elif is_finished(video):
+            state.update(source_path, videoId=video.videoId, status='finished')
+            return video.videoId
+        elif not is_failed(video):
+            # 仍在处理中，等待已有的任务完成
+            state.update(source_path, videoId=video.videoId, status='queued')
+            return video.videoId
+        else:
+            # 与重复的合并请求一致，重新入库前重置状态，避免轮询时被当作仍然失败
+            video.status = StatusEnum.UPLOADING.value
+            video.metadata = {**(video.metadata or {}), 'job': {'stage': 'queued'}}
+            video.save()
+
+        tasks.ingest_video.delay(video.videoId, file_hash, file_ext)
+        state.update(source_path, videoId=video.videoId, status='queued')
+        self.stdout.write(f'queued {source_path} as {video.videoId}')
+        return video.videoId
+
+    def poll(self, inflight: dict, state: ImportState):
+        videos = {video.videoId: video for video in Video.objects.filter(videoId__in=list(inflight))}
+        for video_id in list(inflight):
+            video = videos.get(video_id)
+            if video is not None and is_finished(video):
+                state.update(inflight.pop(video_id), status='finished')
+            elif video is None or is_failed(video):
+                error = (video.metadata or {}).get('job', {}).get('error') if video else 'video has been deleted'
+                self.fail(inflight, video_id, state, error)
+            elif self.is_stalled(video):
+                self.fail(inflight, video_id, state, f'no progress for {self.stall_timeout:.0f}s')
+
+    def is_stalled(self, video: Video) -> bool:
+        """worker异常退出等情况下视频可能一直停留在处理中，状态、任务阶段和转码进度长时间不变时视为卡住"""
+        progress = get_progress(video.videoId) or {}
+        snapshot = (video.status, json.dumps((video.metadata or {}).get('job'), sort_keys=True),
+                    progress.get('updatedAt'))
+        now = time.time()
+        last_snapshot, changed_at = self.activity.get(video.videoId, (None, now))
+        if snapshot != last_snapshot:
+            self.activity[video.videoId] = (snapshot, now)
+            return False
+        return bool(self.stall_timeout) and now - changed_at > self.stall_timeout
+
+    def fail(self, inflight: dict, video_id: str, state: ImportState, error: str):
+        source_path = inflight.pop(video_id)
+        self.activity.pop(video_id, None)
+        state.update(source_path, status='failed', error=error)
+        self.stderr.write(f'{source_path} failed: {error}')
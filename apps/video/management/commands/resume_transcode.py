@@ -0,0 +1,38 @@
+import os
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from apps.video import tasks
+from apps.video.models import MediaObject, StatusEnum, Video
+from apps.video.service import VideoUploadService
+
+
+class Command(BaseCommand):
+    help = '重新执行视频的转码流水线，默认从第一个未完成的阶段继续'
+
+    def add_arguments(self, parser):
+        parser.add_argument('video_id', type=str, help='video id')
+        parser.add_argument('--from-stage', type=str, choices=tasks.PIPELINE_STAGES, default=None,
+                            help='从指定阶段开始重新执行，该阶段及之后的结果将被丢弃')
+
+    def handle(self, *args, **options):
+        video_id = options['video_id']
+        try:
+            video = Video.objects.get(videoId=video_id)
+            media_object = MediaObject.objects.get(fileHash=video.fileHash)
+        except (Video.DoesNotExist, MediaObject.DoesNotExist):
+            raise CommandError(f'video {video_id} or its media object does not exist')
+
+        if options['from_stage']:
+            tasks.reset_stages(video_id, options['from_stage'])
+        if media_object.status == StatusEnum.FINISHED.value:
+            # 重新转码已发布的内容，发布阶段会再次更新所有引用它的视频
+            media_object.status = StatusEnum.PROCESSING.value
+            media_object.save()
+        Video.objects.filter(videoId=video_id).update(status=StatusEnum.PROCESSING.value)
+
+        input_path = os.path.join(settings.MEDIA_ROOT, media_object.filePath)
+        mpd_path = VideoUploadService().generate_mpd_path(input_path, video.fileHash)
+        tasks.video_process.delay(input_path, mpd_path, video_id)
+        self.stdout.write(f'video {video_id} queued, completed stages: {list(tasks.get_stages(video_id))}')
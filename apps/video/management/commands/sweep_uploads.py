@@ -0,0 +1,23 @@
+from django.core.management import BaseCommand
+
+from apps.video.tasks import get_pending_ingest_hashes
+from service.upload_gc import UPLOAD_GC_ACTIVE_WINDOW, UPLOAD_GC_BYTE_BUDGET, UPLOAD_GC_MAX_AGE, sweep_uploads
+
+
+class Command(BaseCommand):
+    help = '清理临时目录中被放弃的上传切片'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=UPLOAD_GC_MAX_AGE, help='超过此秒数未写入的上传将被清理')
+        parser.add_argument('--byte-budget', type=int, default=UPLOAD_GC_BYTE_BUDGET, help='临时目录允许占用的最大字节数')
+        parser.add_argument('--active-window', type=int, default=UPLOAD_GC_ACTIVE_WINDOW,
+                            help='此秒数内仍有写入的上传视为正在进行，不会被清理')
+        parser.add_argument('--workers', type=int, default=8, help='并行扫描的线程数')
+        parser.add_argument('--dry-run', action='store_true', help='只统计，不删除')
+
+    def handle(self, *args, **options):
+        result = sweep_uploads(options['max_age'], options['byte_budget'], options['active_window'],
+                               workers=options['workers'], dry_run=options['dry_run'],
+                               keep_hashes=get_pending_ingest_hashes())
+        self.stdout.write('scanned {scanned} uploads ({totalBytes} bytes), evicted {evicted}, '
+                          'reclaimed {reclaimedBytes} bytes'.format(**result))
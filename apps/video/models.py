@@ -41,9 +41,32 @@ class Video(models.Model):
                                          verbose_name="三元组字幕文件路径")
     surgery_info = models.JSONField(default=dict, verbose_name="手术信息")
     view_count = models.IntegerField(default=0, verbose_name="视频浏览量")
+    fileHash = models.CharField(max_length=64, null=True, blank=True, db_index=True,
+                                verbose_name="源视频文件哈希")
 
     class Meta:
         db_table = 'video'
+        constraints = [
+            # 同一课程重复提交同一视频时复用已有记录，避免重复转码
+            models.UniqueConstraint(fields=['fileHash', 'courseId'], name='unique_video_file_hash_course'),
+        ]
+
+
+class MediaObject(models.Model):
+    """按内容哈希存储的源视频文件，内容相同的视频只存储和转码一次"""
+    fileHash = models.CharField(unique=True, max_length=64, verbose_name="文件哈希")
+    filePath = models.CharField(max_length=255, verbose_name="文件路径")
+    fileSize = models.BigIntegerField(default=0, verbose_name="文件大小")
+    resolutionVersion = models.CharField(max_length=50, null=True, blank=True,
+                                         verbose_name="分辨率版本")
+    status = models.IntegerField(default=StatusEnum.PROCESSING.value,
+                                 choices=Video.StatusChoices.choices,
+                                 verbose_name="转码状态")
+    createdAt = models.DateTimeField(auto_now_add=True,
+                                     verbose_name="创建时间")
+
+    class Meta:
+        db_table = 'media_object'
 
 
 class CaptionAudio(models.Model):
@@ -0,0 +1,73 @@
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+# 转码进度写入缓存的最小间隔，单位秒
+PROGRESS_PUBLISH_INTERVAL = getattr(settings, 'VIDEO_PROGRESS_PUBLISH_INTERVAL', 2)
+# 进度在缓存中的有效期，worker异常退出后进度会在此时间后消失，单位秒
+PROGRESS_TIMEOUT = 10 * 60
+
+
+def get_progress_key(video_id: str) -> str:
+    return f'video_progress:{video_id}'
+
+
+def get_progress(video_id: str) -> Optional[dict]:
+    """
+    查询视频的转码进度，没有进行中的转码时返回None
+
+    :return: 包括阶段stage、完成百分比percent、编码帧率fps、编码速度speed(相对于实时播放的倍数)、
+             预计剩余秒数eta及进度更新时间updatedAt，updatedAt长时间不变说明任务可能已卡住
+    """
+    return cache.get(get_progress_key(video_id))
+
+
+class ProgressReporter:
+    """
+    将ffmpeg的进度发布到缓存，可直接作为transcode中各函数的on_progress回调
+
+    ffmpeg每秒会输出多次进度，按PROGRESS_PUBLISH_INTERVAL节流后再写入缓存
+    """
+
+    def __init__(self, video_id: str, stage: str, duration: float):
+        self.video_id = video_id
+        self.stage = stage
+        self.duration = duration
+        self._last_publish = 0.0
+
+    def __call__(self, out_time: float, fps: Optional[float], speed: Optional[float], finished: bool = False):
+        now = time.time()
+        if not finished and now - self._last_publish < PROGRESS_PUBLISH_INTERVAL:
+            return
+        self._last_publish = now
+        percent = 100.0 if finished else min(out_time / self.duration * 100, 99.9) if self.duration else None
+        eta = (self.duration - out_time) / speed if speed and self.duration and not finished else None
+        cache.set(get_progress_key(self.video_id), {
+            'stage': self.stage,
+            'percent': round(percent, 1) if percent is not None else None,
+            'fps': fps,
+            'speed': speed,
+            'eta': round(max(eta, 0), 1) if eta is not None else None,
+            'updatedAt': int(now),
+        }, PROGRESS_TIMEOUT)
+
+
+def report_segment_done(video_id: str, total: int):
+    """分段并行转码时各段分别在不同worker上执行，以完成的段数作为进度"""
+    done_key = f'{get_progress_key(video_id)}:segments'
+    cache.add(done_key, 0, PROGRESS_TIMEOUT)
+    done = cache.incr(done_key)
+    cache.set(get_progress_key(video_id), {
+        'stage': 'encode',
+        'percent': round(min(done / total, 1) * 100, 1),
+        'fps': None,
+        'speed': None,
+        'eta': None,
+        'updatedAt': int(time.time()),
+    }, PROGRESS_TIMEOUT)
+
+
+def clear_progress(video_id: str):
+    cache.delete_many([get_progress_key(video_id), f'{get_progress_key(video_id)}:segments'])
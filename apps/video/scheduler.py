@@ -0,0 +1,97 @@
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def _get_total_memory_mb() -> int:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return 16 * 1024
+
+
+# 本节点可用于转码的资源，同一节点上的所有worker进程共用
+NODE_CPU_CORES = getattr(settings, 'VIDEO_NODE_CPU_CORES', os.cpu_count() or 1)
+NODE_MEMORY_MB = getattr(settings, 'VIDEO_NODE_MEMORY_MB', _get_total_memory_mb())
+# 显卡允许同时存在的NVENC编码会话数，消费级显卡有数量限制，为None时不限制
+NODE_NVENC_SESSIONS = getattr(settings, 'VIDEO_NODE_NVENC_SESSIONS', None)
+# 每个转码任务至少占用的资源
+JOB_MIN_THREADS = getattr(settings, 'VIDEO_JOB_MIN_THREADS', 4)
+JOB_MEMORY_MB = getattr(settings, 'VIDEO_JOB_MEMORY_MB', 2048)
+# 每个转码任务同时编码的分辨率数，使用NVENC时每个分辨率占用一个编码会话
+JOB_NVENC_SESSIONS = getattr(settings, 'VIDEO_JOB_NVENC_SESSIONS', 3)
+# 节点内各进程通过此目录下的文件锁协调，必须位于本地文件系统
+SLOT_DIR = getattr(settings, 'VIDEO_SLOT_DIR', os.path.join(tempfile.gettempdir(), 'video_transcode_slots'))
+
+
+class JobBudget:
+    """
+    单个转码任务分得的资源
+
+    :param threads: 编码线程总数，同时编码多个分辨率时平均分配
+    :param filter_threads: 滤镜(缩放等)使用的线程数
+    """
+
+    def __init__(self, threads: int, filter_threads: int):
+        self.threads = threads
+        self.filter_threads = filter_threads
+
+
+def get_slot_count(hardware: bool = False) -> int:
+    """按CPU、内存和NVENC会话数中最紧张的一项计算本节点可同时执行的转码任务数"""
+    slots = min(NODE_CPU_CORES // JOB_MIN_THREADS, NODE_MEMORY_MB // JOB_MEMORY_MB)
+    if hardware and NODE_NVENC_SESSIONS is not None:
+        slots = min(slots, NODE_NVENC_SESSIONS // JOB_NVENC_SESSIONS)
+    return max(slots, 1)
+
+
+def get_job_budget(slot_count: int) -> JobBudget:
+    # 核数在各任务间平均分配，任务数少时每个任务可以使用更多线程
+    threads = max(NODE_CPU_CORES // slot_count, 1)
+    return JobBudget(threads=threads, filter_threads=max(threads // 2, 1))
+
+
+@contextmanager
+def transcode_slot(hardware: bool = False, poll_interval: float = 2):
+    """
+    节点级的转码信号量，没有空闲名额时等待
+
+    每个名额对应SLOT_DIR下的一个文件锁，持有者进程退出时锁由系统自动释放，不会因worker异常退出而泄漏名额
+    :param hardware: 是否使用硬件编码，使用时名额数还受NVENC会话数限制
+    :return: 本任务分得的资源
+    """
+    slot_count = get_slot_count(hardware)
+    budget = get_job_budget(slot_count)
+    if fcntl is None:
+        yield budget
+        return
+    os.makedirs(SLOT_DIR, exist_ok=True)
+    waited = False
+    while True:
+        for i in range(slot_count):
+            fd = os.open(os.path.join(SLOT_DIR, f'slot_{i}.lock'), os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                yield budget
+            finally:
+                os.close(fd)
+            return
+        if not waited:
+            logger.info('all %d transcode slots are busy, waiting', slot_count)
+            waited = True
+        time.sleep(poll_interval)
@@ -1,3 +1,4 @@
+import errno
 import os
 import shutil
 import subprocess
@@ -6,12 +7,21 @@ from pathlib import Path
 from typing import Sequence
 
 import ffmpeg
+from django.conf import settings
+from django.db import IntegrityError
 from rest_framework.viewsets import ModelViewSet
 
-from apps.video.models import StatusEnum
+from apps.video.encoders import select_encoder
+from apps.video.models import MediaObject, StatusEnum, Video
+from apps.video.transcode import THUMBNAIL_VTT_NAME, get_hls_master_path, get_thumbnail_dir, probe_source
 from service.multipart_file_upload import MultipartFileUploadService
 from defog.defog import DefogModel
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
 
 def extract_ext(file_path: str):
     if "." not in file_path:
@@ -20,8 +30,212 @@ def extract_ext(file_path: str):
     return file_path.rsplit(".", 1)
 
 
+MEDIA_ROOT = settings.MEDIA_ROOT
+# linux的FICLONE ioctl，在btrfs、xfs等文件系统上创建与源文件共享数据块的副本(reflink)
+FICLONE = 0x40049409
+
+
+def link_or_copy(source_path: str, target_path: str) -> str:
+    """
+    将文件放到target_path，尽量不复制数据：优先创建硬链接；同一文件系统内不允许硬链接时(如链接数已达上限)尝试reflink；
+    跨文件系统时硬链接和reflink都不可用，只能完整复制
+
+    :return: 实际使用的方式，hardlink / reflink / copy
+    """
+    try:
+        os.link(source_path, target_path)
+        return 'hardlink'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    tmp_path = target_path + '.tmp'
+    same_device = os.stat(source_path).st_dev == os.stat(os.path.dirname(os.path.abspath(target_path))).st_dev
+    with open(source_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        try:
+            if fcntl is None or not same_device:
+                raise OSError(errno.ENOTSUP, 'reflink is not supported')
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            method = 'reflink'
+        except OSError:
+            shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+            method = 'copy'
+    os.replace(tmp_path, target_path)
+    return method
+
+
 class VideoUploadService(MultipartFileUploadService):
 
+    def get_content_dir(self, file_hash: str):
+        """
+        源视频及其转码产物按内容哈希分级存储，如videos/ab/cd/abcd1234...
+
+        相同内容的视频总是落在同一目录，避免按时间划分目录导致的目录数量膨胀
+        """
+        return os.path.join(MEDIA_ROOT, 'videos', file_hash[:2], file_hash[2:4], file_hash)
+
+    def verify_should_upload(self, file_hash: str, file_ext: str, *args, **kwargs):
+        # 内容相同的视频已经入库时直接秒传
+        if MediaObject.objects.filter(fileHash=file_hash).exists():
+            return {
+                'shouldUpload': False
+            }
+        return super().verify_should_upload(file_hash, file_ext, *args, **kwargs)
+
+    def store_media_object(self, file_hash: str, file_ext: str):
+        """
+        将合并完成的视频存入内容寻址存储
+
+        内容相同的视频已存在时直接复用，删除本次上传的临时文件
+        :return: (MediaObject, 是否为新存储的对象)
+        """
+        media_object = MediaObject.objects.filter(fileHash=file_hash).first()
+        if media_object is not None:
+            tmp_path = self._get_file_path(file_hash, file_ext)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return media_object, False
+
+        origin_path = self.merge_file_chunk(file_hash, file_ext)
+        target_dir = self.get_content_dir(file_hash)
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+        target_path = shutil.move(origin_path, os.path.join(target_dir, os.path.basename(origin_path)))
+        try:
+            media_object = MediaObject.objects.create(
+                fileHash=file_hash,
+                filePath=os.path.relpath(target_path, MEDIA_ROOT),
+                fileSize=os.path.getsize(target_path),
+            )
+        except IntegrityError:
+            # 并发合并同一视频时只有一个请求能创建成功，其余请求复用已有对象
+            return MediaObject.objects.get(fileHash=file_hash), False
+        return media_object, True
+
+    def import_media_object(self, file_hash: str, source_path: str):
+        """
+        将服务器本地已有的视频文件存入内容寻址存储，用于批量导入存档视频
+
+        通过link_or_copy放入存储目录，源文件保持不变；内容相同的视频已存在时直接复用
+        :return: (MediaObject, 是否为新存储的对象)
+        """
+        media_object = MediaObject.objects.filter(fileHash=file_hash).first()
+        if media_object is not None:
+            return media_object, False
+        target_dir = self.get_content_dir(file_hash)
+        os.makedirs(target_dir, exist_ok=True)
+        target_path = os.path.join(target_dir, f'{file_hash}{os.path.splitext(source_path)[1].lower()}')
+        if not os.path.exists(target_path):
+            link_or_copy(source_path, target_path)
+        try:
+            media_object = MediaObject.objects.create(
+                fileHash=file_hash,
+                filePath=os.path.relpath(target_path, MEDIA_ROOT),
+                fileSize=os.path.getsize(target_path),
+            )
+        except IntegrityError:
+            return MediaObject.objects.get(fileHash=file_hash), False
+        return media_object, True
+
+    def generate_video_paths(self, file_hash: str, file_ext: str, video_id: str):
+        """
+        在视频入库之前确定其各项路径，路径只取决于内容哈希，因此可以先创建视频记录再在后台处理
+
+        :return: (源视频路径, 本视频的mpd路径, 封面路径)
+        """
+        media_object = MediaObject.objects.filter(fileHash=file_hash).first()
+        if media_object is not None:
+            target_path = os.path.join(MEDIA_ROOT, media_object.filePath)
+        else:
+            target_path = os.path.join(self.get_content_dir(file_hash), f'{file_hash}{file_ext}')
+        mpd_path = self.generate_linked_mpd_path(self.generate_mpd_path(target_path, file_hash), video_id)
+        return target_path, mpd_path, self.generate_poster_path(target_path, file_hash)
+
+    def is_upload_complete(self, file_hash: str, file_ext: str) -> bool:
+        if MediaObject.objects.filter(fileHash=file_hash).exists():
+            return True
+        return super().is_upload_complete(file_hash, file_ext)
+
+    def generate_linked_mpd_path(self, mpd_path: str, video_id: str):
+        """内容相同的视频共用同一组DASH分片，但需要各自的mpd路径以满足videoUrl的唯一约束"""
+        return mpd_path.replace('stream.mpd', f'stream_{video_id}.mpd')
+
+    def link_mpd(self, mpd_path: str, linked_mpd_path: str):
+        """
+        ffmpeg重新封装时会以改名的方式替换mpd文件，已有的硬链接仍指向旧文件，因此每次发布都重新链接，
+        先链接到临时路径再改名，替换过程中播放器不会读到不存在的mpd
+        """
+        tmp_path = linked_mpd_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(mpd_path, tmp_path)
+        except OSError:
+            # 文件系统不支持硬链接时复制，mpd文件很小
+            shutil.copyfile(mpd_path, tmp_path)
+        os.replace(tmp_path, linked_mpd_path)
+
+    def get_video_probe(self, video: Video, input_path: str = None) -> dict:
+        """
+        获取视频的probe摘要，见transcode.probe_source
+
+        摘要只在第一次获取时probe并保存到Video.metadata['probe']，内容相同的视频直接复用已有的摘要
+        :param input_path: 源视频路径，默认为视频对应的内容寻址存储中的文件
+        """
+        metadata = video.metadata or {}
+        if metadata.get('probe'):
+            return metadata['probe']
+        sibling = Video.objects.filter(fileHash=video.fileHash, metadata__has_key='probe').exclude(
+            videoId=video.videoId).first() if video.fileHash else None
+        if sibling is not None:
+            probe = sibling.metadata['probe']
+        else:
+            if input_path is None:
+                input_path = os.path.join(MEDIA_ROOT, MediaObject.objects.get(fileHash=video.fileHash).filePath)
+            probe = probe_source(input_path)
+        # 重新读取metadata，避免覆盖后台任务期间写入的其它字段
+        metadata = Video.objects.get(videoId=video.videoId).metadata or {}
+        metadata['probe'] = probe
+        Video.objects.filter(videoId=video.videoId).update(metadata=metadata)
+        video.metadata = metadata
+        return probe
+
+    def publish_media_object(self, file_hash: str, resolution_version: str, partial: bool = False):
+        """
+        源视频转码完成后更新其状态，并发布所有引用此视频、仍在等待转码的重复上传
+
+        :param partial: 只完成了部分分辨率，视频已可播放，但源视频仍处于转码中，其余分辨率完成后会再次发布
+        """
+        media_object = MediaObject.objects.get(fileHash=file_hash)
+        if not partial:
+            media_object.status = StatusEnum.FINISHED.value
+        media_object.resolutionVersion = resolution_version
+        media_object.save()
+
+        mpd_path = self.generate_mpd_path(os.path.join(MEDIA_ROOT, media_object.filePath), file_hash)
+        # 已部分发布的视频状态已为FINISHED，同样需要更新
+        for video in Video.objects.filter(fileHash=file_hash,
+                                          status__in=[StatusEnum.PROCESSING.value, StatusEnum.FINISHED.value]):
+            video_mpd_path = os.path.join(MEDIA_ROOT, video.videoUrl)
+            if os.path.normpath(video_mpd_path) != os.path.normpath(mpd_path):
+                self.link_mpd(mpd_path, video_mpd_path)
+            video.status = StatusEnum.FINISHED.value
+            video.resolutionVersion = resolution_version
+            self.set_hls_url(video, mpd_path)
+            self.set_thumbnails_url(video, mpd_path)
+            video.save()
+
+    def set_hls_url(self, video: Video, mpd_path: str):
+        """记录与mpd共用分片的HLS主播放列表，内容相同的视频共用同一个播放列表；CMAF封装之前转码的视频没有HLS"""
+        hls_path = get_hls_master_path(mpd_path)
+        if os.path.exists(hls_path):
+            video.metadata = {**(video.metadata or {}), 'hlsUrl': os.path.relpath(hls_path, MEDIA_ROOT)}
+
+    def set_thumbnails_url(self, video: Video, mpd_path: str):
+        """记录进度条预览的WebVTT缩略图索引，雪碧图与索引位于同一目录，内容相同的视频共用"""
+        vtt_path = os.path.join(get_thumbnail_dir(mpd_path), THUMBNAIL_VTT_NAME)
+        if os.path.exists(vtt_path):
+            video.metadata = {**(video.metadata or {}), 'thumbnailsUrl': os.path.relpath(vtt_path, MEDIA_ROOT)}
+
     def generate_mpd_path(self, video_path: str, file_hash: str):
         parent_dir = Path(video_path).parent
         dash_dir = os.path.join(parent_dir, f'dash_{file_hash}')
@@ -74,8 +288,9 @@ class VideoUploadService(MultipartFileUploadService):
         threading.Thread(target=time_consuming_process).start()
 
     def convert2dash(self, input_path_list: Sequence[str], mpd_path: str):
-        input_list = [ffmpeg.input(file_path, hwaccel='cuda') for file_path in input_path_list]
-        ffmpeg.output(*input_list, mpd_path, vcodec='h264_nvenc', acodec="aac",
+        encoder = select_encoder()
+        input_list = [ffmpeg.input(file_path, **encoder.input_kwargs()) for file_path in input_path_list]
+        ffmpeg.output(*input_list, mpd_path, acodec="aac", **encoder.output_kwargs(),
                       seg_duration=5,
                       adaptation_sets="id=0,streams=v id=1,streams=a",
                       f="dash").run(quiet=True)
@@ -114,31 +329,33 @@ class VideoUploadService(MultipartFileUploadService):
         probe = ffmpeg.probe(input_path)
         has_audio = any(stream.get('codec_type') == 'audio' for stream in probe['streams'])
 
+        encoder = select_encoder()
         for i, target_resolution in enumerate(target_resolution_list):
             output_path = f'{file_path_}_{target_resolution}.{ext}'
             print(output_path)
             output_path_list.append(output_path)
-            input_ = ffmpeg.input(input_path, hwaccel='cuda')
+            input_ = ffmpeg.input(input_path, **encoder.input_kwargs())
             video = input_.video.filter('scale', target_resolution).filter('setdar', '16/9')
 
             if has_audio:
-                output = video.output(input_.audio, output_path, vcodec='h264_nvenc', b=target_bv_list[i])
+                output = video.output(input_.audio, output_path, **encoder.output_kwargs([target_bv_list[i]]))
             else:
-                output = video.output(output_path, vcodec='h264_nvenc', b=target_bv_list[i])
+                output = video.output(output_path, **encoder.output_kwargs([target_bv_list[i]]))
             output_list.append(output)
 
         ffmpeg.merge_outputs(*output_list).run(quiet=True)
         return output_path_list
 
-    def generate_video_poster(self, video_path: str, poster_path: str):
-        probe = ffmpeg.probe(video_path)
-        video_duration = float(probe['format']['duration'])
+    def generate_video_poster(self, video_path: str, poster_path: str, video_duration: float = None):
+        if video_duration is None:
+            probe = ffmpeg.probe(video_path)
+            video_duration = float(probe['format']['duration'])
         if video_duration >= 60.0:  # 大于等于1分钟
             time_point = "00:01:00"
         else:  # 小于1分钟
             time_point = "00:00:00"
         try:
-            ffmpeg.input(video_path, ss=time_point).output(poster_path, vframes=1).run(quiet=True)
+            ffmpeg.input(video_path, ss=time_point).output(poster_path, vframes=1).overwrite_output().run(quiet=True)
         except ffmpeg.Error as e:
             print("An error occurred while generating the video poster: {0}".format(e))
 
@@ -1,13 +1,40 @@
+import os
+import shutil
 from typing import Sequence
 
 import ffmpeg
-from celery import shared_task
+from celery import chord, shared_task
+from django.conf import settings
+from django.db.models import Q
 
-from apps.video.models import StatusEnum, Video
+from apps.video.encoders import VIDEO_ENCODER_FAMILY, select_encoder
+from apps.video.models import MediaObject, StatusEnum, Video
+from apps.video.progress import ProgressReporter, clear_progress, report_segment_done
+from apps.video.scheduler import JobBudget, transcode_slot
+from apps.video.service import VideoUploadService
+from apps.video import transcode
+from apps.video.ladder import choose_ladder
 from defog.defog import DefogModel
+from service.upload_gc import sweep_uploads
+from utils.lock import get_redis, redis_lock
 import logging
 logger = logging.getLogger(__name__)
 
+# 转码方式，single_pass为一次解码编码出各分辨率再直接封装为DASH，two_pass为先转出各分辨率mp4再重新编码为DASH
+VIDEO_TRANSCODE_MODE = getattr(settings, 'VIDEO_TRANSCODE_MODE', 'single_pass')
+# single_pass方式下，时长不少于此值的视频切成多段分发给多个worker并行转码，单位秒，为None时不分段
+VIDEO_SEGMENT_PARALLEL_MIN_DURATION = getattr(settings, 'VIDEO_SEGMENT_PARALLEL_MIN_DURATION', 20 * 60)
+# 分段并行转码时每段的时长，单位秒
+VIDEO_SEGMENT_TIME = getattr(settings, 'VIDEO_SEGMENT_TIME', 5 * 60)
+# 源视频与分辨率阶梯中某一级相符时直接复制，不重新编码该级
+VIDEO_STREAM_COPY = getattr(settings, 'VIDEO_STREAM_COPY', True)
+# single_pass方式下先编码并发布最低的分辨率，视频即可播放，其余分辨率完成后再加入mpd
+VIDEO_PROGRESSIVE_PUBLISH = getattr(settings, 'VIDEO_PROGRESSIVE_PUBLISH', True)
+# 转码任务失败后的最大重试次数，重试全部失败后视频标记为转码失败
+VIDEO_PROCESS_MAX_RETRIES = 4
+# 分段并行转码进行中的标记的有效期，worker异常退出导致chord回调和错误回调都未执行时，标记在此时间后失效，单位秒
+VIDEO_SEGMENT_CHORD_TIMEOUT = getattr(settings, 'VIDEO_SEGMENT_CHORD_TIMEOUT', 24 * 3600)
+
 
 def extract_ext(file_path: str):
     if "." not in file_path:
@@ -18,79 +45,523 @@ def extract_ext(file_path: str):
 
 def resolution_conversion_new(input_path: str,
                               target_resolution_list: Sequence[str],
-                              target_bv_list: Sequence[str]):
+                              target_bv_list: Sequence[str],
+                              has_audio: bool = None):
     file_path_, ext = extract_ext(input_path)
     output_list = []
     output_path_list = []
 
     # 检查音频流是否存在
-    probe = ffmpeg.probe(input_path)
-    has_audio = any(
-        stream.get('codec_type') == 'audio' for stream in probe['streams'])
+    if has_audio is None:
+        probe = ffmpeg.probe(input_path)
+        has_audio = any(
+            stream.get('codec_type') == 'audio' for stream in probe['streams'])
 
+    encoder = select_encoder()
     for i, target_resolution in enumerate(target_resolution_list):
         output_path = f'{file_path_}_{target_resolution}.{ext}'
         print(output_path)
         output_path_list.append(output_path)
-        input_ = ffmpeg.input(input_path, hwaccel='cuda')
+        input_ = ffmpeg.input(input_path, **encoder.input_kwargs())
         video = input_.video.filter('scale', target_resolution).filter(
             'setdar', '16/9')
 
         if has_audio:
             output = video.output(input_.audio, output_path,
-                                  vcodec='h264_nvenc', b=target_bv_list[i])
+                                  **encoder.output_kwargs([target_bv_list[i]]))
         else:
-            output = video.output(output_path, vcodec='h264_nvenc',
-                                  b=target_bv_list[i])
+            output = video.output(output_path,
+                                  **encoder.output_kwargs([target_bv_list[i]]))
         output_list.append(output)
 
-    ffmpeg.merge_outputs(*output_list).run(quiet=True)
+    ffmpeg.merge_outputs(*output_list).overwrite_output().run(quiet=True)
     return output_path_list
 
 
-def defog_video(input_path: str):
-    defog_model = DefogModel(input_path)
+def defog_video(input_path: str, fps: float = None):
+    defog_model = DefogModel(input_path, fps)
     defog_model.video2image()
     defog_model.inference()
     defog_video_path = defog_model.image2video()
     return defog_video_path
 
 
-def convert2dash(input_path_list: Sequence[str], mpd_path: str):
-    input_list = [ffmpeg.input(file_path, hwaccel='cuda') for file_path in input_path_list]
-    ffmpeg.output(*input_list, mpd_path, vcodec='h264_nvenc', acodec="aac",
+def convert2dash(input_path_list: Sequence[str], mpd_path: str, audio_source: str = None):
+    """
+    :param audio_source: 共用的音轨，见transcode.encode_audio，直接复制；为None时只封装视频
+    """
+    encoder = select_encoder()
+    streams = [ffmpeg.input(file_path, **encoder.input_kwargs()).video for file_path in input_path_list]
+    audio_kwargs = {}
+    if audio_source is not None:
+        streams.append(ffmpeg.input(audio_source).audio)
+        audio_kwargs['acodec'] = 'copy'
+    ffmpeg.output(*streams, mpd_path, **audio_kwargs, **encoder.output_kwargs(),
                   seg_duration=5,
-                  adaptation_sets="id=0,streams=v id=1,streams=a",
-                  f="dash").run(quiet=True)
+                  adaptation_sets="id=0,streams=v id=1,streams=a" if audio_source else "id=0,streams=v",
+                  **transcode.CMAF_OUTPUT_KWARGS,
+                  f="dash").overwrite_output().run(quiet=True)
+
+
+def update_job(video_id: str, **fields):
+    """更新Video.metadata中记录的后台任务状态"""
+    video = Video.objects.get(videoId=video_id)
+    metadata = video.metadata or {}
+    metadata['job'] = {**metadata.get('job', {}), **fields}
+    Video.objects.filter(videoId=video_id).update(metadata=metadata)
+
+
+# 转码流水线的各个阶段，依次执行，每个阶段完成后将结果记录在Video.metadata['stages']中，
+# 重试或手动重新执行时跳过已完成的阶段，从第一个未完成的阶段继续
+PIPELINE_STAGES = ['probe', 'poster', 'audio', 'ladder', 'thumbnails', 'preview', 'encode', 'package', 'publish']
+
+
+def get_stages(video_id: str) -> dict:
+    video = Video.objects.get(videoId=video_id)
+    return (video.metadata or {}).get('stages', {})
+
+
+def complete_stage(video_id: str, stage: str, result=True):
+    """记录阶段的结果，encode阶段按分辨率分别记录，result为{分辨率: 输出路径}"""
+    video = Video.objects.get(videoId=video_id)
+    metadata = video.metadata or {}
+    stages = metadata.setdefault('stages', {})
+    if stage == 'encode':
+        stages['encode'] = {**stages.get('encode', {}), **result}
+    else:
+        stages[stage] = result
+    Video.objects.filter(videoId=video_id).update(metadata=metadata)
+
+
+def reset_stages(video_id: str, from_stage: str = PIPELINE_STAGES[0]):
+    """清除from_stage及之后各阶段的完成记录，下次执行时从from_stage开始"""
+    video = Video.objects.get(videoId=video_id)
+    metadata = video.metadata or {}
+    stages = metadata.get('stages', {})
+    for stage in PIPELINE_STAGES[PIPELINE_STAGES.index(from_stage):]:
+        stages.pop(stage, None)
+    Video.objects.filter(videoId=video_id).update(metadata=metadata)
+
+
+def get_probe(video_id: str, input_path: str = None) -> dict:
+    """源视频的probe摘要，只在第一次获取时probe"""
+    return VideoUploadService().get_video_probe(Video.objects.get(videoId=video_id), input_path)
+
+
+def get_rendition_dir(mpd_path: str) -> str:
+    return os.path.join(os.path.dirname(mpd_path), 'renditions')
 
 
 @shared_task(bind=True)
-def video_process(self, input_path: str, mpd_path: str, video_id: str):
+def ingest_video(self, video_id: str, file_hash: str, file_ext: str):
+    """
+    在后台完成视频入库的全部步骤：合并切片 -> 存入内容寻址存储 -> 转码
+    """
+    service = VideoUploadService()
     try:
-        # self.generate_video_poster(input_path, poster_path)
-        # todo step1 将原视频交给去雾模型进行演算
-        # step2 将去雾视频转换为其它分辨率，共3个分辨率以供选择(1920x1080, 1280x720, 640x360)
-        # multi_resolution_output = self.resolution_conversion(input_path, ['1920x1080', '1280x720', '640x360'])
-        multi_resolution_output = resolution_conversion_new(input_path, ['1920x1080', '1280x720', '640x360'], ['8M', '4.5M', '1.5M'])
-
-        if_defog = False
-        if if_defog:
-            defog_video_path = defog_video(input_path)
-            multi_resolution_output_defog = resolution_conversion_new(
-                defog_video_path,
-                ['1920x1080', '1280x720', '640x360'],
-                ['8.1M', '4.6M', '1.6M'])
-            # step3 将原视频和去雾视频转为dash(异步)
-            convert2dash(
-                multi_resolution_output + multi_resolution_output_defog, mpd_path)
+        update_job(video_id, stage='merging', taskId=self.request.id)
+        # 同一内容的多个入库任务依次执行，后执行的任务会发现内容已入库，直接复用
+        with redis_lock(f'ingest:{file_hash}', blocking=True):
+            media_object, created = service.store_media_object(file_hash, file_ext)
+        Video.objects.filter(videoId=video_id).update(status=StatusEnum.PROCESSING.value)
+        target_path = os.path.join(settings.MEDIA_ROOT, media_object.filePath)
+        # 入库时probe一次，之后的各处理步骤均读取保存的摘要
+        update_job(video_id, stage='probe')
+        get_probe(video_id, target_path)
+        complete_stage(video_id, 'probe')
+        # 封面只截取一帧，在入库任务中生成，不占用转码队列
+        run_poster_stage(target_path, video_id)
+        # 本视频已为PROCESSING之后再读取转码状态，之后完成的转码在发布时一定会更新本视频
+        media_object.refresh_from_db()
+        if not created and media_object.status == StatusEnum.FINISHED.value:
+            # 内容相同的视频已入库并转码完成，复用其转码结果
+            service.publish_media_object(file_hash, media_object.resolutionVersion)
+            update_job(video_id, stage='finished')
+            return
+
+        # 内容相同的视频正在转码时，转码任务会因拿不到锁而跳过并标记为waiting，等待其完成后一并发布；
+        # 之前的转码失败时则由本视频的转码任务接着完成
+        update_job(video_id, stage='transcoding')
+        video_process.delay(target_path, service.generate_mpd_path(target_path, file_hash), video_id)
+    except Exception as e:
+        logger.exception('ingest video %s failed', video_id)
+        Video.objects.filter(videoId=video_id).update(status=StatusEnum.UNKNOWN.value)
+        update_job(video_id, stage='failed', error=str(e))
+
+
+@shared_task(bind=True)
+def video_process(self, input_path: str, mpd_path: str, video_id: str):
+    video = Video.objects.get(videoId=video_id)
+    # 同一视频同一时刻只允许一个转码任务，重试或重复投递的任务直接跳过
+    with redis_lock(f'video_process:{video.fileHash or video_id}') as acquired:
+        if not acquired:
+            logger.info('video %s is being processed by another task, skip', video_id)
+            if (video.metadata or {}).get('job', {}).get('stage') == 'transcoding':
+                # 本视频的转码尚未开始，在等待内容相同的视频转码完成；重复投递的任务不覆盖正在执行的阶段
+                update_job(video_id, stage='waiting')
+            return
+        if is_segment_chord_pending(video_id):
+            # 分段转码已分发，锁已释放但各段仍在转码，重新执行会删除正在使用的分段目录
+            logger.info('segments of video %s are being transcoded, skip', video_id)
+            return
+        media_object = MediaObject.objects.filter(fileHash=video.fileHash).first() if video.fileHash else None
+        if media_object is not None and media_object.status == StatusEnum.FINISHED.value:
+            # 等待期间内容相同的视频已转码完成，发布时本视频可能还不是PROCESSING而被跳过，再发布一次
+            logger.info('media object of video %s has been processed, publish it directly', video_id)
+            VideoUploadService().publish_media_object(video.fileHash, media_object.resolutionVersion)
+            update_job(video_id, stage='finished')
+            return
+        try:
+            stages = get_stages(video_id)
+            if 'probe' not in stages:
+                update_job(video_id, stage='probe')
+                get_probe(video_id, input_path)
+                complete_stage(video_id, 'probe')
+            probe = get_probe(video_id, input_path)
+            if 'poster' not in stages:
+                run_poster_stage(input_path, video_id)
+            if 'audio' not in stages:
+                run_audio_stage(input_path, mpd_path, video_id)
+            audio_source = get_audio_source(video_id)
+
+            # self.generate_video_poster(input_path, poster_path)
+            # todo step1 将原视频交给去雾模型进行演算
+            # step2 将去雾视频转换为其它分辨率，共3个分辨率以供选择(1920x1080, 1280x720, 640x360)
+            # multi_resolution_output = self.resolution_conversion(input_path, ['1920x1080', '1280x720', '640x360'])
+            if_defog = False
+            if 'package' not in stages:
+                # 按本节点的资源预算限制同时执行的转码任务数，等待空闲名额
+                with transcode_slot(select_encoder().is_hardware) as budget:
+                    if if_defog:
+                        multi_resolution_output = resolution_conversion_new(input_path, ['1920x1080', '1280x720', '640x360'], ['8M', '4.5M', '1.5M'], False)
+                        defog_video_path = defog_video(input_path, probe['fps'])
+                        multi_resolution_output_defog = resolution_conversion_new(
+                            defog_video_path,
+                            ['1920x1080', '1280x720', '640x360'],
+                            ['8.1M', '4.6M', '1.6M'], False)
+                        # step3 将原视频和去雾视频转为dash(异步)
+                        convert2dash(
+                            multi_resolution_output + multi_resolution_output_defog, mpd_path, audio_source)
+                    elif VIDEO_TRANSCODE_MODE == 'single_pass':
+                        if 'ladder' not in stages:
+                            run_ladder_stage(input_path, mpd_path, video_id)
+                        ladder = get_ladder(video_id)
+                        if VIDEO_PROGRESSIVE_PUBLISH and 'preview' not in stages:
+                            # 分段转码的视频同样先发布最低分辨率，长视频等待全部分段完成的时间更长，更需要先行播放；
+                            # 各段仍编码全部分辨率，拼接后的mpd中各分辨率的分片边界保持一致
+                            run_preview_stage(input_path, mpd_path, video_id, ladder, budget)
+                        if should_split(probe):
+                            # 长视频分段并行转码，由chord回调完成后续步骤
+                            dispatch_segment_transcode(input_path, mpd_path, video_id, ladder)
+                            return
+                        run_encode_stage(input_path, mpd_path, video_id, ladder, budget)
+                        run_package_stage(input_path, mpd_path, video_id, ladder)
+                    else:
+                        multi_resolution_output = resolution_conversion_new(input_path, ['1920x1080', '1280x720', '640x360'], ['8M', '4.5M', '1.5M'], False)
+                        convert2dash(multi_resolution_output, mpd_path, audio_source)
+                    if 'thumbnails' not in get_stages(video_id):
+                        run_thumbnail_stage(input_path, mpd_path, video_id)
+            if 'package' not in get_stages(video_id):
+                complete_stage(video_id, 'package', os.path.relpath(mpd_path, settings.MEDIA_ROOT))
+
+            finish_video_process(video_id)
+        except Exception as e:
+            if self.request.retries >= VIDEO_PROCESS_MAX_RETRIES:
+                logger.exception('transcode video %s failed', video_id)
+                mark_transcode_failed(video_id, e)
+                raise
+            self.retry(exc=e, countdown=4, max_retries=VIDEO_PROCESS_MAX_RETRIES)
+
+
+def run_ladder_stage(input_path: str, mpd_path: str, video_id: str):
+    """按VIDEO_LADDER_POLICY选择本视频的分辨率阶梯，见apps.video.ladder"""
+    update_job(video_id, stage='ladder')
+    complete_stage(video_id, 'ladder', choose_ladder(input_path, get_probe(video_id), get_rendition_dir(mpd_path)))
+
+
+def get_ladder(video_id: str):
+    return [tuple(rung) for rung in get_stages(video_id)['ladder']['rungs']]
+
+
+def get_stream_copy_resolution(video_id: str, ladder):
+    if not VIDEO_STREAM_COPY:
+        return None
+    return transcode.find_stream_copy_rung(get_probe(video_id), ladder, VIDEO_ENCODER_FAMILY)
+
+
+def run_poster_stage(input_path: str, video_id: str):
+    video = Video.objects.get(videoId=video_id)
+    update_job(video_id, stage='poster')
+    poster_path = os.path.join(settings.MEDIA_ROOT, video.coverImgUrl)
+    VideoUploadService().generate_video_poster(input_path, poster_path, get_probe(video_id)['duration'])
+    complete_stage(video_id, 'poster', video.coverImgUrl)
+
+
+def run_encode_stage(input_path: str, mpd_path: str, video_id: str, ladder, budget: JobBudget = None):
+    """
+    编码尚未完成的分辨率
+
+    各分辨率的输出文件名带有指纹(见transcode.rendition_fingerprint)，重新执行、重试或调整分辨率阶梯后，
+    指纹相同且文件存在的分辨率直接复用，只编码缺少的分辨率，如后续增加4K
+    """
+    copy_resolution = get_stream_copy_resolution(video_id, ladder)
+    if copy_resolution is not None:
+        # 该分辨率直接以源视频作为编码结果，封装时复制其视频流
+        complete_stage(video_id, 'encode', {copy_resolution: os.path.relpath(input_path, settings.MEDIA_ROOT)})
+    stages = get_stages(video_id)
+    rendition_dir = get_rendition_dir(mpd_path)
+    os.makedirs(rendition_dir, exist_ok=True)
+    encoder = select_encoder()
+    source_hash = Video.objects.get(videoId=video_id).fileHash or video_id
+    reused, pending = {}, []
+    for resolution, bitrate in ladder:
+        if resolution == copy_resolution:
+            continue
+        fingerprint = transcode.rendition_fingerprint(source_hash, resolution, bitrate, encoder)
+        output_path = transcode.get_rendition_path(rendition_dir, resolution, fingerprint)
+        if os.path.exists(output_path):
+            reused[resolution] = os.path.relpath(output_path, settings.MEDIA_ROOT)
         else:
-            convert2dash(multi_resolution_output, mpd_path)
+            pending.append((resolution, bitrate, output_path))
+    if reused:
+        logger.info('video %s reuses encoded renditions %s', video_id, list(reused))
+        complete_stage(video_id, 'encode', reused)
+    if not pending:
+        return
+    update_job(video_id, stage='encode')
+    duration = get_probe(video_id)['duration']
+    # 预览雪碧图随编码一并生成
+    thumbnail_dir = None if 'thumbnails' in stages else transcode.get_thumbnail_dir(mpd_path)
+    transcode.encode_renditions(input_path, pending, encoder, ProgressReporter(video_id, 'encode', duration),
+                                threads=budget and budget.threads, filter_threads=budget and budget.filter_threads,
+                                thumbnail_dir=thumbnail_dir)
+    complete_stage(video_id, 'encode', {resolution: os.path.relpath(output_path, settings.MEDIA_ROOT)
+                                        for resolution, _, output_path in pending})
+    if thumbnail_dir is not None:
+        complete_thumbnail_stage(mpd_path, video_id)
+
+
+def run_thumbnail_stage(input_path: str, mpd_path: str, video_id: str):
+    """没有在编码时生成预览雪碧图的视频(分段并行转码、各分辨率均直接复制等)单独生成一次"""
+    update_job(video_id, stage='thumbnails')
+    transcode.generate_thumbnails(input_path, transcode.get_thumbnail_dir(mpd_path),
+                                  ProgressReporter(video_id, 'thumbnails', get_probe(video_id)['duration']))
+    complete_thumbnail_stage(mpd_path, video_id)
+
+
+def complete_thumbnail_stage(mpd_path: str, video_id: str):
+    """生成WebVTT缩略图索引，记录索引和雪碧图的路径，发布时写入metadata['thumbnailsUrl']"""
+    vtt_path, sprites = transcode.write_thumbnail_vtt(transcode.get_thumbnail_dir(mpd_path),
+                                                      get_probe(video_id)['duration'])
+    complete_stage(video_id, 'thumbnails', {
+        'vtt': os.path.relpath(vtt_path, settings.MEDIA_ROOT),
+        'sprites': [os.path.relpath(sprite, settings.MEDIA_ROOT) for sprite in sprites],
+    })
+
+
+def run_package_stage(input_path: str, mpd_path: str, video_id: str, ladder):
+    """将各分辨率的编码结果封装为DASH，不重新编码视频"""
+    stages = get_stages(video_id)
+    probe = get_probe(video_id)
+    update_job(video_id, stage='package')
+    # 按分辨率从低到高排列，逐步加入分辨率时已有分辨率的序号保持不变，正在播放部分mpd的播放器不受影响
+    streams = [ffmpeg.input(os.path.join(settings.MEDIA_ROOT, stages['encode'][resolution])).video
+               for resolution, _ in sorted(ladder, key=lambda rung: transcode.get_pixel_count(rung[0]))]
+    transcode.package_dash(streams, mpd_path, get_audio_source(video_id),
+                           ProgressReporter(video_id, 'package', probe['duration']))
+
+
+def run_audio_stage(input_path: str, mpd_path: str, video_id: str):
+    """单独处理一次音轨，所有分辨率共用，源视频没有音轨时记录为None"""
+    probe = get_probe(video_id)
+    if not probe['hasAudio']:
+        complete_stage(video_id, 'audio', None)
+        return
+    update_job(video_id, stage='audio')
+    rendition_dir = get_rendition_dir(mpd_path)
+    os.makedirs(rendition_dir, exist_ok=True)
+    audio_path = transcode.get_audio_path(rendition_dir)
+    transcode.encode_audio(input_path, audio_path, probe['audioCodec'],
+                           ProgressReporter(video_id, 'audio', probe['duration']))
+    complete_stage(video_id, 'audio', os.path.relpath(audio_path, settings.MEDIA_ROOT))
+
 
-        # 更新数据库状态
-        video = Video.objects.get(videoId=video_id)
+def get_audio_source(video_id: str):
+    audio_url = get_stages(video_id).get('audio')
+    return os.path.join(settings.MEDIA_ROOT, audio_url) if audio_url else None
+
+
+def run_preview_stage(input_path: str, mpd_path: str, video_id: str, ladder, budget: JobBudget = None):
+    """
+    只编码并封装最低的分辨率，随即发布，视频即可播放
+
+    其余分辨率随后在一次解码中一并编码完成，再重新封装为包含全部分辨率的mpd
+    """
+    lowest_rung = min(ladder, key=lambda rung: transcode.get_pixel_count(rung[0]))
+    run_encode_stage(input_path, mpd_path, video_id, [lowest_rung], budget)
+    run_package_stage(input_path, mpd_path, video_id, [lowest_rung])
+    publish_video(video_id, lowest_rung[0], partial=True)
+    complete_stage(video_id, 'preview')
+
+
+def should_split(probe: dict) -> bool:
+    if VIDEO_SEGMENT_PARALLEL_MIN_DURATION is None:
+        return False
+    return probe['duration'] >= VIDEO_SEGMENT_PARALLEL_MIN_DURATION
+
+
+def publish_video(video_id: str, resolution_version: str, partial: bool = False):
+    video = Video.objects.get(videoId=video_id)
+    if video.fileHash:
+        # 发布所有内容相同、等待本次转码结果的视频，包括本视频
+        VideoUploadService().publish_media_object(video.fileHash, resolution_version, partial)
+    else:
         video.status = StatusEnum.FINISHED.value
-        video.resolutionVersion = '1920x1080,1280x720,640x360'
+        video.resolutionVersion = resolution_version
+        VideoUploadService().set_hls_url(video, os.path.join(settings.MEDIA_ROOT, video.videoUrl))
         video.save()
+
+
+def finish_video_process(video_id: str):
+    """转码完成后更新数据库状态"""
+    update_job(video_id, stage='publish')
+    ladder = get_stages(video_id).get('ladder')
+    if ladder:
+        resolution_version = ','.join(resolution for resolution, _ in ladder['rungs'])
+    else:
+        resolution_version = '1920x1080,1280x720,640x360'
+    publish_video(video_id, resolution_version)
+    complete_stage(video_id, 'publish')
+    update_job(video_id, stage='finished')
+    clear_progress(video_id)
+
+
+def get_segment_work_dir(mpd_path: str) -> str:
+    return os.path.join(os.path.dirname(mpd_path), 'parts')
+
+
+def get_segment_output_dir(mpd_path: str) -> str:
+    """各段的编码结果，与单次转码的各分辨率输出一样保留，重新转码时按指纹复用"""
+    return os.path.join(get_rendition_dir(mpd_path), 'segments')
+
+
+def get_segment_chord_key(video_id: str) -> str:
+    video = Video.objects.get(videoId=video_id)
+    return f'segment_chord:{video.fileHash or video_id}'
+
+
+def is_segment_chord_pending(video_id: str) -> bool:
+    return bool(get_redis().exists(get_segment_chord_key(video_id)))
+
+
+def set_segment_chord_pending(video_id: str):
+    get_redis().set(get_segment_chord_key(video_id), video_id, ex=VIDEO_SEGMENT_CHORD_TIMEOUT)
+
+
+def clear_segment_chord_pending(video_id: str):
+    get_redis().delete(get_segment_chord_key(video_id))
+
+
+def dispatch_segment_transcode(input_path: str, mpd_path: str, video_id: str, ladder):
+    """
+    将源视频在关键帧处切成多段，以chord的形式分发给worker池并行转码，全部完成后拼接为DASH
+
+    各段文件位于MEDIA_ROOT下，多节点部署时需要各节点共享该目录
+    """
+    work_dir = get_segment_work_dir(mpd_path)
+    # 只清理上次切分的分段文件，各段的编码结果按指纹复用
+    shutil.rmtree(work_dir, ignore_errors=True)
+    clear_progress(video_id)
+    duration = get_probe(video_id)['duration']
+    update_job(video_id, stage='split')
+    parts = transcode.split_source(input_path, work_dir, VIDEO_SEGMENT_TIME,
+                                   ProgressReporter(video_id, 'split', duration))
+    update_job(video_id, stage='encode', segments=len(parts))
+    copy_resolution = get_stream_copy_resolution(video_id, ladder)
+    # 在stitch_segments或segment_transcode_failed中清除
+    set_segment_chord_pending(video_id)
+    output_dir = get_segment_output_dir(mpd_path)
+    # 切分在关键帧处进行，相同内容按相同时长切分的结果一致，以内容哈希和分段序号标识各段
+    source_key = Video.objects.get(videoId=video_id).fileHash or video_id
+    callback = stitch_segments.s(input_path, mpd_path, video_id).on_error(segment_transcode_failed.s(video_id))
+    try:
+        chord(transcode_video_segment.s(part, output_dir, f'{source_key}:{VIDEO_SEGMENT_TIME}:{i}',
+                                        ladder, video_id, len(parts), copy_resolution)
+              for i, part in enumerate(parts))(callback)
+    except Exception:
+        clear_segment_chord_pending(video_id)
+        raise
+
+
+@shared_task(bind=True)
+def transcode_video_segment(self, part_path: str, output_dir: str, source_id: str, ladder, video_id: str, total: int,
+                            copy_resolution: str = None):
+    """转码一段视频，返回各分辨率的输出路径"""
+    try:
+        with transcode_slot(select_encoder().is_hardware) as budget:
+            outputs = transcode.transcode_segment(part_path, output_dir, source_id, [tuple(rung) for rung in ladder],
+                                                  copy_resolution=copy_resolution, threads=budget.threads,
+                                                  filter_threads=budget.filter_threads)
+        report_segment_done(video_id, total)
+        return outputs
     except Exception as e:
         self.retry(exc=e, countdown=4, max_retries=4)
 
+
+@shared_task(bind=True)
+def stitch_segments(self, segment_outputs, input_path: str, mpd_path: str, video_id: str):
+    """chord回调，按顺序拼接各段的转码结果并封装为DASH"""
+    try:
+        if 'thumbnails' not in get_stages(video_id):
+            run_thumbnail_stage(input_path, mpd_path, video_id)
+        if 'package' not in get_stages(video_id):
+            probe = get_probe(video_id)
+            update_job(video_id, stage='package')
+            # 与run_package_stage一致按分辨率从低到高排列，正在播放预览mpd的播放器不受影响
+            ladder = get_ladder(video_id)
+            order = sorted(range(len(ladder)), key=lambda i: transcode.get_pixel_count(ladder[i][0]))
+            segment_outputs = [[outputs[i] for i in order] for outputs in segment_outputs]
+            transcode.stitch_to_dash(segment_outputs, mpd_path, get_audio_source(video_id),
+                                     ProgressReporter(video_id, 'package', probe['duration']))
+            complete_stage(video_id, 'package', os.path.relpath(mpd_path, settings.MEDIA_ROOT))
+            shutil.rmtree(get_segment_work_dir(mpd_path), ignore_errors=True)
+        clear_segment_chord_pending(video_id)
+        finish_video_process(video_id)
+    except Exception as e:
+        self.retry(exc=e, countdown=4, max_retries=4)
+
+
+@shared_task
+def segment_transcode_failed(request, exc, traceback, video_id: str):
+    """分段转码中任一任务最终失败时，标记视频转码失败"""
+    logger.error('segment transcode of video %s failed: %s', video_id, exc)
+    clear_segment_chord_pending(video_id)
+    mark_transcode_failed(video_id, exc)
+
+
+def mark_transcode_failed(video_id: str, exc: BaseException):
+    """
+    标记视频转码失败，界面上显示错误，重新提交时可以重新入库
+
+    等待本次转码结果的重复上传同样标记为失败；已部分发布的视频保持可播放，只记录错误
+    """
+    video = Video.objects.get(videoId=video_id)
+    videos = Video.objects.filter(fileHash=video.fileHash) if video.fileHash else Video.objects.filter(videoId=video_id)
+    failed_ids = set(videos.filter(status=StatusEnum.PROCESSING.value).values_list('videoId', flat=True))
+    Video.objects.filter(videoId__in=failed_ids).update(status=StatusEnum.UNKNOWN.value)
+    for failed_id in failed_ids | {video_id}:
+        update_job(failed_id, stage='failed', error=str(exc))
+
+
+def get_pending_ingest_hashes() -> set:
+    """已上传完成、入库任务尚未合并切片的视频，其切片长时间没有写入，但不能被清理"""
+    videos = Video.objects.filter(Q(status=StatusEnum.UPLOADING.value) | Q(metadata__job__stage='queued'))
+    return set(videos.exclude(fileHash=None).values_list('fileHash', flat=True))
+
+
+@shared_task
+def sweep_upload_tmp():
+    """定期清理临时目录中被放弃的上传切片"""
+    result = sweep_uploads(keep_hashes=get_pending_ingest_hashes())
+    logger.info('upload tmp sweep finished: %s', result)
+    return result
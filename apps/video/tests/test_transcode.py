@@ -0,0 +1,210 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from apps.video import ladder, transcode
+from apps.video.encoders import EncoderProfile
+
+LIBX264 = EncoderProfile('libx264', 'h264', preset='veryfast', quality=23, threads=0)
+NVENC = EncoderProfile('h264_nvenc', 'h264', hwaccel='cuda', preset='p4', quality=23, quality_option='cq')
+
+
+def make_probe(width: int, height: int, **fields) -> dict:
+    return {'width': width, 'height': height, 'duration': 600, **fields}
+
+
+class TestChooseLadder(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for patcher in (mock.patch.object(ladder, 'VIDEO_LADDER', transcode.DEFAULT_LADDER),
+                        mock.patch.object(ladder, 'COMPLEXITY_REFERENCE_BITRATE', 800 * 1000),
+                        mock.patch.object(ladder, 'LADDER_SCALE_RANGE', (0.4, 1.5)),
+                        mock.patch.object(ladder, 'select_encoder', return_value=LIBX264)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_drop_upscaled_rungs(self):
+        cases = [
+            # (源视频宽, 高, 保留的分辨率)
+            (3840, 2160, ['1920x1080', '1280x720', '640x360']),
+            (1920, 1080, ['1920x1080', '1280x720', '640x360']),
+            (1920, 800, ['1280x720', '640x360']),
+            (1280, 720, ['1280x720', '640x360']),
+            (720, 576, ['640x360']),
+            (640, 360, ['640x360']),
+            # 源视频低于最低一级时仍保留最低一级
+            (320, 240, ['640x360']),
+        ]
+        for width, height, expected in cases:
+            with self.subTest(source=f'{width}x{height}'):
+                rungs = ladder.drop_upscaled_rungs(transcode.DEFAULT_LADDER, make_probe(width, height))
+                self.assertEqual([resolution for resolution, _ in rungs], expected)
+
+    def test_drop_upscaled_rungs_sorts_from_high_to_low(self):
+        shuffled = [('640x360', '1.5M'), ('1920x1080', '8M'), ('1280x720', '4.5M')]
+        self.assertEqual(ladder.drop_upscaled_rungs(shuffled, make_probe(1920, 1080)), transcode.DEFAULT_LADDER)
+
+    def test_format_bitrate(self):
+        cases = [(8000000, '8000k'), (3624000, '3600k'), (1875000, '1900k'), (40000, '100k'), (0, '100k')]
+        for bitrate, expected in cases:
+            with self.subTest(bitrate=bitrate):
+                self.assertEqual(ladder.format_bitrate(bitrate), expected)
+
+    def test_content_aware(self):
+        cases = [
+            # (源视频宽, 高, 复杂度, 选定的阶梯)
+            (1920, 1080, 800 * 1000, [['1920x1080', '8000k'], ['1280x720', '4500k'], ['640x360', '1500k']]),
+            (1280, 720, 1000 * 1000, [['1280x720', '5600k'], ['640x360', '1900k']]),
+            # 复杂度超出范围时按上下限调整
+            (1920, 1080, 4000 * 1000, [['1920x1080', '12000k'], ['1280x720', '6800k'], ['640x360', '2200k']]),
+            (640, 360, 100 * 1000, [['640x360', '600k']]),
+        ]
+        for width, height, complexity, expected in cases:
+            with self.subTest(source=f'{width}x{height}', complexity=complexity), \
+                    mock.patch.object(ladder, 'VIDEO_LADDER_POLICY', 'content_aware'), \
+                    mock.patch.object(transcode, 'measure_complexity', return_value=complexity) as measure:
+                result = ladder.choose_ladder('input.mp4', make_probe(width, height), self.tmp_dir)
+                self.assertEqual(result, {'policy': 'content_aware', 'complexity': complexity, 'rungs': expected})
+                measure.assert_called_once_with('input.mp4', 600, self.tmp_dir, encoder=LIBX264)
+
+    def test_fixed(self):
+        with mock.patch.object(ladder, 'VIDEO_LADDER_POLICY', 'fixed'), \
+                mock.patch.object(transcode, 'measure_complexity') as measure:
+            result = ladder.choose_ladder('input.mp4', make_probe(1280, 720), self.tmp_dir)
+        measure.assert_not_called()
+        self.assertEqual(result, {'policy': 'fixed', 'complexity': None,
+                                  'rungs': [['1280x720', '4.5M'], ['640x360', '1.5M']]})
+
+
+class TestThumbnailVtt(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def make_sprites(self, count: int):
+        for i in range(1, count + 1):
+            open(os.path.join(self.tmp_dir, transcode.THUMBNAIL_SPRITE_PATTERN % i), 'wb').close()
+
+    def read_cues(self, vtt_path: str):
+        with open(vtt_path, encoding='utf-8') as f:
+            blocks = f.read().strip().split('\n\n')
+        self.assertEqual(blocks[0], 'WEBVTT')
+        return [block.split('\n') for block in blocks[1:]]
+
+    def test_format_vtt_time(self):
+        cases = [(0, '00:00:00.000'), (5, '00:00:05.000'), (131.5, '00:02:11.500'), (3725.25, '01:02:05.250'),
+                 (59.9996, '00:01:00.000')]
+        for seconds, expected in cases:
+            with self.subTest(seconds=seconds):
+                self.assertEqual(transcode._format_vtt_time(seconds), expected)
+
+    def test_cues(self):
+        self.make_sprites(2)
+        vtt_path, sprites = transcode.write_thumbnail_vtt(self.tmp_dir, 131.5)
+        self.assertEqual(vtt_path, os.path.join(self.tmp_dir, transcode.THUMBNAIL_VTT_NAME))
+        self.assertEqual([os.path.basename(sprite) for sprite in sprites], ['sprite_001.jpg', 'sprite_002.jpg'])
+        cues = self.read_cues(vtt_path)
+        self.assertEqual(len(cues), 27)
+        cases = [
+            # (cue序号, 时间, 雪碧图中的位置)
+            (0, '00:00:00.000 --> 00:00:05.000', 'sprite_001.jpg#xywh=0,0,160,90'),
+            (4, '00:00:20.000 --> 00:00:25.000', 'sprite_001.jpg#xywh=640,0,160,90'),
+            (6, '00:00:30.000 --> 00:00:35.000', 'sprite_001.jpg#xywh=160,90,160,90'),
+            (24, '00:02:00.000 --> 00:02:05.000', 'sprite_001.jpg#xywh=640,360,160,90'),
+            (25, '00:02:05.000 --> 00:02:10.000', 'sprite_002.jpg#xywh=0,0,160,90'),
+            # 最后一条cue截止于视频结尾
+            (26, '00:02:10.000 --> 00:02:11.500', 'sprite_002.jpg#xywh=160,0,160,90'),
+        ]
+        for index, timing, position in cases:
+            with self.subTest(cue=index):
+                self.assertEqual(cues[index], [timing, position])
+
+    def test_cues_limited_by_sprites(self):
+        # 雪碧图数量不足时只为已生成的缩略图写cue
+        self.make_sprites(1)
+        vtt_path, _ = transcode.write_thumbnail_vtt(self.tmp_dir, 600)
+        cues = self.read_cues(vtt_path)
+        self.assertEqual(len(cues), 25)
+        self.assertEqual(cues[-1], ['00:02:00.000 --> 00:02:05.000', 'sprite_001.jpg#xywh=640,360,160,90'])
+
+    def test_no_sprites(self):
+        vtt_path, sprites = transcode.write_thumbnail_vtt(self.tmp_dir, 60)
+        self.assertEqual(sprites, [])
+        self.assertEqual(self.read_cues(vtt_path), [])
+
+
+class TestFindStreamCopyRung(SimpleTestCase):
+    def make_probe(self, **fields) -> dict:
+        probe = make_probe(1280, 720, videoCodec='h264', pixFmt='yuv420p', keyframeInterval=2.5,
+                           keyframeRegular=True, videoBitRate=4000 * 1000, bitRate=4200 * 1000)
+        probe.update(fields)
+        return probe
+
+    def test_cases(self):
+        cases = [
+            ('matching rung', {}, '1280x720'),
+            ('keyframe interval equals segment duration', {'keyframeInterval': 5}, '1280x720'),
+            ('keyframe interval of 1s', {'keyframeInterval': 1}, '1280x720'),
+            ('bitrate at tolerance', {'videoBitRate': 5400 * 1000}, '1280x720'),
+            ('container bitrate fallback', {'videoBitRate': None}, '1280x720'),
+            ('other codec', {'videoCodec': 'hevc'}, None),
+            ('other pixel format', {'pixFmt': 'yuv422p'}, None),
+            ('irregular keyframes', {'keyframeRegular': False}, None),
+            ('unknown keyframe interval', {'keyframeInterval': None}, None),
+            ('keyframe interval longer than segment', {'keyframeInterval': 6}, None),
+            ('keyframe interval not dividing segment', {'keyframeInterval': 3}, None),
+            ('bitrate above tolerance', {'videoBitRate': 5500 * 1000}, None),
+            ('unknown bitrate', {'videoBitRate': None, 'bitRate': None}, None),
+            ('resolution not in ladder', {'width': 1280, 'height': 544}, None),
+        ]
+        for name, fields, expected in cases:
+            with self.subTest(name):
+                self.assertEqual(transcode.find_stream_copy_rung(self.make_probe(**fields), transcode.DEFAULT_LADDER,
+                                                                 'h264'), expected)
+
+    def test_codec_must_match_ladder(self):
+        self.assertIsNone(transcode.find_stream_copy_rung(self.make_probe(), transcode.DEFAULT_LADDER, 'hevc'))
+
+
+class TestRenditionFingerprint(SimpleTestCase):
+    def test_stable(self):
+        fingerprint = transcode.rendition_fingerprint('abc', '1280x720', '4.5M', LIBX264)
+        self.assertRegex(fingerprint, r'^[0-9a-f]{16}$')
+        self.assertEqual(transcode.rendition_fingerprint('abc', '1280x720', '4.5M', LIBX264), fingerprint)
+        # 同名同参数的另一个编码配置对象
+        same_profile = EncoderProfile('libx264', 'h264', preset='veryfast', quality=23, threads=0)
+        self.assertEqual(transcode.rendition_fingerprint('abc', '1280x720', '4.5M', same_profile), fingerprint)
+
+    def test_threads_ignored(self):
+        fingerprint = transcode.rendition_fingerprint('abc', '1280x720', '4.5M', LIBX264)
+        for threads in (None, 4, 16):
+            with self.subTest(threads=threads):
+                profile = EncoderProfile('libx264', 'h264', preset='veryfast', quality=23, threads=threads)
+                self.assertEqual(transcode.rendition_fingerprint('abc', '1280x720', '4.5M', profile), fingerprint)
+
+    def test_changes_with_inputs(self):
+        fingerprint = transcode.rendition_fingerprint('abc', '1280x720', '4.5M', LIBX264)
+        cases = [
+            ('source', ('abd', '1280x720', '4.5M', LIBX264)),
+            ('resolution', ('abc', '640x360', '4.5M', LIBX264)),
+            ('bitrate', ('abc', '1280x720', '4500k', LIBX264)),
+            ('encoder', ('abc', '1280x720', '4.5M', NVENC)),
+            ('preset', ('abc', '1280x720', '4.5M', EncoderProfile('libx264', 'h264', preset='slow', threads=0))),
+            ('options', ('abc', '1280x720', '4.5M', EncoderProfile('libx264', 'h264', preset='veryfast',
+                                                                   options={'profile:v': 'high'}))),
+        ]
+        for name, args in cases:
+            with self.subTest(name):
+                self.assertNotEqual(transcode.rendition_fingerprint(*args), fingerprint)
+
+    def test_rendition_path(self):
+        self.assertEqual(transcode.get_rendition_path('/work', '1280x720', '0123456789abcdef'),
+                         os.path.join('/work', 'rendition_1280x720_0123456789abcdef.mp4'))
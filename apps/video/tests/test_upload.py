@@ -0,0 +1,245 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase
+
+from service import multipart_file_upload
+from service.multipart_file_upload import ChunkTruncatedError, MultipartFileUploadService
+from service.streaming_hash import FileHashState, ResumableMd5
+from service.upload_manifest import (CHUNK_MISSING, CHUNK_RECEIVED, CHUNK_VERIFIED, MANIFEST_HEADER, MANIFEST_RECORD,
+                                     UploadManifest, to_ranges)
+
+CHUNK_SIZE = 1000
+FILE_EXT = '.mp4'
+
+
+def make_content(size: int) -> bytes:
+    return bytes(i * 7 % 251 for i in range(size))
+
+
+def make_chunk(data: bytes, declared_size: int = None) -> SimpleUploadedFile:
+    chunk = SimpleUploadedFile('blob', data)
+    if declared_size is not None:
+        # 客户端声明的大小，与实际收到的内容不一致时模拟中途断开的请求
+        chunk.size = declared_size
+    return chunk
+
+
+class TestUploadManifest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'manifest_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_create_preallocated(self):
+        manifest = UploadManifest.create(self.path, total_size=2500, chunk_size=1000)
+        self.assertEqual(manifest.chunk_count, 3)
+        self.assertTrue(manifest.is_preallocated)
+        self.assertEqual(os.path.getsize(self.path), MANIFEST_HEADER.size + 3 * MANIFEST_RECORD.size)
+        self.assertEqual(manifest.missing_count(), 3)
+
+    def test_records_round_trip(self):
+        manifest = UploadManifest.create(self.path, total_size=2500, chunk_size=1000)
+        digest = hashlib.md5(b'chunk').digest()
+        manifest.mark_received(2, 500, digest)
+        manifest.mark_received(0, 1000, digest, verified=True)
+
+        loaded = UploadManifest.load(self.path)
+        self.assertEqual((loaded.total_size, loaded.chunk_size), (2500, 1000))
+        self.assertEqual(loaded.records[0], (CHUNK_VERIFIED, 1000, digest))
+        self.assertEqual(loaded.records[1], (CHUNK_MISSING, 0, bytes(16)))
+        self.assertEqual(loaded.records[2], (CHUNK_RECEIVED, 500, digest))
+        self.assertEqual(loaded.received_indexes(), [0, 2])
+        self.assertEqual(loaded.verified_indexes(), [0])
+        self.assertEqual(loaded.received_size(), 1500)
+        self.assertEqual(loaded.get_digest(2), digest)
+        self.assertIsNone(loaded.get_digest(1))
+
+        loaded.mark_missing(2)
+        self.assertEqual(UploadManifest.load(self.path).received_indexes(), [0])
+
+    def test_chunk_dir_manifest_grows(self):
+        manifest = UploadManifest.ensure(self.path)
+        self.assertFalse(manifest.is_preallocated)
+        self.assertEqual(manifest.chunk_count, 0)
+        manifest.mark_received(3, 10)
+        loaded = UploadManifest.ensure(self.path)
+        self.assertEqual(loaded.chunk_count, 4)
+        self.assertEqual(loaded.received_indexes(), [3])
+        self.assertEqual(loaded.missing_count(), 3)
+
+    def test_load_ignores_partial_record(self):
+        manifest = UploadManifest.ensure(self.path)
+        manifest.mark_received(0, 10)
+        with open(self.path, 'ab') as f:
+            f.write(b'\x01\x02')
+        self.assertEqual(UploadManifest.load(self.path).received_indexes(), [0])
+
+    def test_load_missing(self):
+        self.assertIsNone(UploadManifest.load(self.path))
+
+    def test_to_ranges(self):
+        cases = [
+            ([], []),
+            ([0], [[0, 0]]),
+            ([0, 1, 2, 5], [[0, 2], [5, 5]]),
+            ([1, 3, 5], [[1, 1], [3, 3], [5, 5]]),
+            ([4, 5, 6, 7, 9, 10], [[4, 7], [9, 10]]),
+        ]
+        for indexes, expected in cases:
+            with self.subTest(indexes=indexes):
+                self.assertEqual(to_ranges(indexes), expected)
+
+
+@unittest.skipUnless(ResumableMd5.available, 'libcrypto is not available')
+class TestResumableMd5(SimpleTestCase):
+    def test_matches_hashlib_across_splits(self):
+        data = make_content(100 * 1024 + 17)
+        for split_size in (1, 63, 64, 65, 4096, len(data)):
+            with self.subTest(split_size=split_size):
+                md5 = ResumableMd5()
+                for offset in range(0, len(data), split_size):
+                    # 每次更新后保存并恢复中间状态，模拟跨请求计算
+                    md5 = ResumableMd5(md5.to_bytes())
+                    md5.update(data[offset:offset + split_size])
+                self.assertEqual(md5.hexdigest(), hashlib.md5(data).hexdigest())
+
+    def test_hexdigest_does_not_finalize(self):
+        md5 = ResumableMd5()
+        md5.update(b'abc')
+        self.assertEqual(md5.hexdigest(), hashlib.md5(b'abc').hexdigest())
+        md5.update(b'def')
+        self.assertEqual(md5.hexdigest(), hashlib.md5(b'abcdef').hexdigest())
+
+    def test_file_hash_state_persists(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir, True)
+        state_path = os.path.join(tmp_dir, 'hashState_test')
+        with FileHashState(state_path) as state:
+            state.update(b'hello ')
+            state.next_index = 1
+        with FileHashState(state_path) as state:
+            self.assertEqual((state.next_index, state.hashed_size), (1, 6))
+            state.update(b'world')
+            self.assertEqual(state.md5.hexdigest(), hashlib.md5(b'hello world').hexdigest())
+
+
+class TestMultipartFileUpload(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(multipart_file_upload, 'TMP_UPLOAD_ROOT', self.tmp_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = MultipartFileUploadService()
+        self.content = make_content(CHUNK_SIZE * 3 + 250)
+        self.file_hash = hashlib.md5(self.content).hexdigest()
+        self.chunks = [self.content[i:i + CHUNK_SIZE] for i in range(0, len(self.content), CHUNK_SIZE)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def upload(self, chunk_index: int, file_hash: str = None, data: bytes = None, declared_size: int = None):
+        file_hash = file_hash or self.file_hash
+        data = self.chunks[chunk_index] if data is None else data
+        self.service.upload_file_chunk(make_chunk(data, declared_size), f'{file_hash}-{chunk_index}', file_hash,
+                                       FILE_EXT)
+
+    def read_merged(self, file_path: str) -> bytes:
+        with open(file_path, 'rb') as f:
+            return f.read()
+
+    def test_chunk_dir_merge_out_of_order(self):
+        for chunk_index in (2, 0, 3, 1):
+            self.upload(chunk_index)
+        self.assertTrue(self.service.is_upload_complete(self.file_hash, FILE_EXT))
+        file_path = self.service.merge_file_chunk(self.file_hash, FILE_EXT)
+        self.assertEqual(self.read_merged(file_path), self.content)
+        self.assertFalse(os.path.exists(self.service._get_chunk_dir(self.file_hash)))
+        self.assertFalse(os.path.exists(self.service._get_manifest_path(self.file_hash)))
+
+    def test_chunk_dir_merge_without_kernel_copy(self):
+        self.service.use_kernel_copy = False
+        for chunk_index in (3, 1, 0, 2):
+            self.upload(chunk_index)
+        file_path = self.service.merge_file_chunk(self.file_hash, FILE_EXT)
+        self.assertEqual(self.read_merged(file_path), self.content)
+
+    def test_preallocated_merge_out_of_order(self):
+        self.service.verify_should_upload(self.file_hash, FILE_EXT, len(self.content), CHUNK_SIZE)
+        for chunk_index in (3, 1, 2, 0):
+            self.upload(chunk_index)
+        res = self.service.verify_should_upload(self.file_hash, FILE_EXT, len(self.content), CHUNK_SIZE, True)
+        self.assertEqual(res['uploadedRanges'], [[0, 3]])
+        self.assertEqual(res['missingRanges'], [])
+        file_path = self.service.merge_file_chunk(self.file_hash, FILE_EXT)
+        self.assertEqual(self.read_merged(file_path), self.content)
+        self.assertFalse(os.path.exists(self.service._get_part_path(self.file_hash, FILE_EXT)))
+
+    def test_merge_with_missing_chunk(self):
+        for chunk_index in (0, 2, 3):
+            self.upload(chunk_index)
+        self.assertFalse(self.service.is_upload_complete(self.file_hash, FILE_EXT))
+        with self.assertRaises(FileNotFoundError):
+            self.service.merge_file_chunk(self.file_hash, FILE_EXT)
+
+    def test_truncated_chunk_rejected(self):
+        self.upload(0)
+        with self.assertRaises(ChunkTruncatedError):
+            self.upload(1, data=self.chunks[1][:-100], declared_size=CHUNK_SIZE)
+        self.assertEqual(self.service.get_uploaded_chunk_list(self.file_hash), [f'{self.file_hash}-0'])
+        self.assertEqual(os.listdir(self.service._get_chunk_dir(self.file_hash)), [f'{self.file_hash}-0'])
+
+    def test_truncated_chunk_rejected_preallocated(self):
+        self.service.verify_should_upload(self.file_hash, FILE_EXT, len(self.content), CHUNK_SIZE)
+        with self.assertRaises(ChunkTruncatedError):
+            self.upload(1, data=self.chunks[1][:-100], declared_size=CHUNK_SIZE)
+        res = self.service.verify_should_upload(self.file_hash, FILE_EXT, len(self.content), CHUNK_SIZE, True)
+        self.assertEqual(res['uploadedRanges'], [])
+        self.assertEqual(res['missingRanges'], [[0, 3]])
+
+    def test_chunk_size_mismatch_rejected_preallocated(self):
+        self.service.verify_should_upload(self.file_hash, FILE_EXT, len(self.content), CHUNK_SIZE)
+        with self.assertRaises(ValueError):
+            self.upload(3, data=self.chunks[3] + b'extra')
+
+    def test_chunk_checksum_mismatch_rejected(self):
+        chunk_name = f'{self.file_hash}-0'
+        with self.assertRaises(ValueError):
+            self.service.upload_file_chunk(make_chunk(self.chunks[0]), chunk_name, self.file_hash, FILE_EXT,
+                                           hashlib.md5(b'other').hexdigest())
+        self.assertEqual(self.service.get_uploaded_chunk_list(self.file_hash), [])
+
+    @unittest.skipUnless(ResumableMd5.available, 'libcrypto is not available')
+    def test_wrong_file_hash_rejected(self):
+        wrong_hash = hashlib.md5(b'another file').hexdigest()
+        for chunk_index in (1, 0, 2, 3):
+            self.upload(chunk_index, file_hash=wrong_hash)
+        with self.assertRaisesRegex(ValueError, 'file hash mismatch'):
+            self.service.merge_file_chunk(wrong_hash, FILE_EXT)
+        self.assertFalse(os.path.exists(self.service._get_file_path(wrong_hash, FILE_EXT)))
+
+    @unittest.skipUnless(ResumableMd5.available, 'libcrypto is not available')
+    def test_wrong_file_hash_rejected_preallocated(self):
+        wrong_hash = hashlib.md5(b'another file').hexdigest()
+        self.service.verify_should_upload(wrong_hash, FILE_EXT, len(self.content), CHUNK_SIZE)
+        for chunk_index in (2, 3, 0, 1):
+            self.upload(chunk_index, file_hash=wrong_hash)
+        with self.assertRaisesRegex(ValueError, 'file hash mismatch'):
+            self.service.merge_file_chunk(wrong_hash, FILE_EXT)
+        self.assertFalse(os.path.exists(self.service._get_file_path(wrong_hash, FILE_EXT)))
+
+    def test_verify_uploaded_chunks(self):
+        for chunk_index in range(4):
+            self.upload(chunk_index)
+        chunk_hashes = {i: hashlib.md5(chunk).hexdigest() for i, chunk in enumerate(self.chunks)}
+        chunk_hashes[2] = hashlib.md5(b'corrupted').hexdigest()
+        res = self.service.verify_should_upload(self.file_hash, FILE_EXT, chunk_hashes=chunk_hashes)
+        self.assertEqual(res['uploadedRanges'], [[0, 1], [3, 3]])
+        self.assertFalse(os.path.exists(self.service._get_chunk_path(self.file_hash, 2)))
@@ -0,0 +1,449 @@
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from fractions import Fraction
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import ffmpeg
+
+from apps.video.encoders import EncoderProfile, select_encoder
+
+logger = logging.getLogger(__name__)
+
+# 默认的分辨率阶梯，依次为(分辨率, 视频码率)
+DEFAULT_LADDER = [('1920x1080', '8M'), ('1280x720', '4.5M'), ('640x360', '1.5M')]
+# DASH分片时长，单位秒
+SEG_DURATION = 5
+# 与mpd位于同一目录的HLS主播放列表
+HLS_MASTER_NAME = 'master.m3u8'
+# CMAF封装参数，分片为fMP4，mpd与HLS播放列表引用同一组分片，支持HLS的客户端(如iOS)无需额外转码
+CMAF_OUTPUT_KWARGS = {
+    'dash_segment_type': 'mp4',
+    'hls_playlist': 1,
+    'hls_master_name': HLS_MASTER_NAME,
+}
+# 源视频码率不超过分辨率阶梯中对应码率的此倍数时才直接复制
+STREAM_COPY_BITRATE_TOLERANCE = 1.2
+# 共用音轨的码率
+AUDIO_BITRATE = '128k'
+# 进度条预览缩略图的截取间隔(秒)、单张尺寸及每张雪碧图的列数和行数
+THUMBNAIL_INTERVAL = 5
+THUMBNAIL_SIZE = (160, 90)
+THUMBNAIL_TILE = (5, 5)
+THUMBNAIL_SPRITE_PATTERN = 'sprite_%03d.jpg'
+THUMBNAIL_VTT_NAME = 'thumbnails.vtt'
+
+
+# 进度回调，参数依次为已处理的时长(秒)、编码帧率、编码速度(相对于实时播放的倍数)、是否已结束
+ProgressCallback = Callable[[float, Optional[float], Optional[float], bool], None]
+
+
+def _parse_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value.rstrip('x'))
+    except (AttributeError, ValueError):
+        # 尚未开始编码时值为N/A
+        return None
+
+
+def _read_progress(stream, on_progress: ProgressCallback):
+    """
+    解析ffmpeg -progress的输出
+
+    输出由若干key=value行组成的块，每块以progress=continue或progress=end结尾
+    """
+    block = {}
+    for line in iter(stream.readline, b''):
+        key, _, value = line.decode(errors='ignore').strip().partition('=')
+        block[key] = value
+        if key != 'progress':
+            continue
+        # out_time_ms名为毫秒，实际与out_time_us一样是微秒
+        out_time = (_parse_float(block.get('out_time_us')) or _parse_float(block.get('out_time_ms')) or 0) / 1e6
+        try:
+            on_progress(out_time, _parse_float(block.get('fps')), _parse_float(block.get('speed')), value == 'end')
+        except Exception:
+            # 进度上报失败不影响转码
+            logger.exception('report ffmpeg progress failed')
+        block = {}
+
+
+def run_ffmpeg(stream_spec, on_progress: ProgressCallback = None):
+    """
+    执行ffmpeg-python构造的命令，通过-progress pipe:1将进度交给读取线程解析后回调on_progress
+
+    输出文件已存在时直接覆盖，失败或被中断的任务留下的临时文件不会阻塞重试；-nostdin避免ffmpeg等待终端输入。
+    失败时与stream_spec.run()一样抛出ffmpeg.Error
+    """
+    stream_spec = stream_spec.overwrite_output().global_args('-nostdin')
+    if on_progress is None:
+        return ffmpeg.run(stream_spec, quiet=True)
+    args = ffmpeg.compile(stream_spec)
+    args = [args[0], '-progress', 'pipe:1', '-nostats', *args[1:]]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    reader = threading.Thread(target=_read_progress, args=(process.stdout, on_progress), daemon=True)
+    reader.start()
+    # 主线程读取stderr，避免管道写满后ffmpeg阻塞
+    stderr = process.stderr.read()
+    retcode = process.wait()
+    reader.join()
+    if retcode:
+        raise ffmpeg.Error('ffmpeg', b'', stderr)
+
+
+def probe_keyframe_interval(input_path: str, window: int = 30) -> Tuple[Optional[float], bool]:
+    """
+    根据开头window秒内视频关键帧的时间间隔估算关键帧间隔
+
+    只读取数据包的标志位，不解码
+    :return: (平均关键帧间隔(秒), 各间隔是否固定)，关键帧少于两个时为(None, False)
+    """
+    probe = ffmpeg.probe(input_path, select_streams='v:0', read_intervals=f'%+{window}',
+                         show_entries='packet=pts_time,flags')
+    keyframe_times = sorted(float(packet['pts_time']) for packet in probe.get('packets', [])
+                            if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A'))
+    if len(keyframe_times) < 2:
+        return None, False
+    interval = (keyframe_times[-1] - keyframe_times[0]) / (len(keyframe_times) - 1)
+    regular = all(abs(b - a - interval) < 0.05 for a, b in zip(keyframe_times, keyframe_times[1:]))
+    return round(interval, 3), regular
+
+
+def probe_source(input_path: str) -> dict:
+    """
+    读取源视频的信息并整理为统一的摘要，结果保存在Video.metadata['probe']中，各处理步骤直接读取，不再重复probe
+
+    :return: 时长duration(秒)、文件大小size、码率bitRate、封装格式formatName、分辨率width/height、帧率fps、
+             视频编码videoCodec、视频码率videoBitRate、像素格式pixFmt、是否有音轨hasAudio、音频编码audioCodec、采样率sampleRate、
+             声道数channels、关键帧间隔keyframeInterval(秒)、
+             关键帧间隔是否固定keyframeRegular及各路流的概要streams
+    """
+    probe = ffmpeg.probe(input_path)
+    video_stream = next(stream for stream in probe['streams'] if stream.get('codec_type') == 'video')
+    audio_stream = next((stream for stream in probe['streams'] if stream.get('codec_type') == 'audio'), None)
+    fps = video_stream.get('avg_frame_rate') or video_stream.get('r_frame_rate')
+    keyframe_interval, keyframe_regular = probe_keyframe_interval(input_path)
+    return {
+        'duration': float(probe['format']['duration']),
+        'size': int(probe['format'].get('size', 0)),
+        'bitRate': int(probe['format'].get('bit_rate', 0)),
+        'formatName': probe['format'].get('format_name'),
+        'width': int(video_stream['width']),
+        'height': int(video_stream['height']),
+        'fps': round(float(Fraction(fps)), 3) if fps and fps != '0/0' else None,
+        'videoCodec': video_stream.get('codec_name'),
+        'videoBitRate': int(video_stream['bit_rate']) if 'bit_rate' in video_stream else None,
+        'pixFmt': video_stream.get('pix_fmt'),
+        'hasAudio': audio_stream is not None,
+        'audioCodec': audio_stream.get('codec_name') if audio_stream else None,
+        'sampleRate': int(audio_stream['sample_rate']) if audio_stream and 'sample_rate' in audio_stream else None,
+        'channels': audio_stream.get('channels') if audio_stream else None,
+        'keyframeInterval': keyframe_interval,
+        'keyframeRegular': keyframe_regular,
+        'streams': [{'index': stream['index'], 'type': stream.get('codec_type'), 'codec': stream.get('codec_name')}
+                    for stream in probe['streams']],
+    }
+
+
+def parse_bitrate(bitrate: str) -> int:
+    """将'4.5M'、'800k'形式的码率转为每秒比特数"""
+    units = {'k': 1000, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3}
+    if bitrate[-1] in units:
+        return int(float(bitrate[:-1]) * units[bitrate[-1]])
+    return int(bitrate)
+
+
+def find_stream_copy_rung(probe: dict, ladder: Sequence[Tuple[str, str]], codec: str) -> Optional[str]:
+    """
+    源视频的编码、分辨率和码率与分辨率阶梯中的某一级相符时，该级可以直接复制源视频流，不必重新编码
+
+    复制的视频流无法强制插入关键帧，因此还要求源视频关键帧间隔固定且能整除DASH分片时长，
+    保证其分片边界与其它编码出的分辨率对齐
+    :param probe: 源视频的probe摘要，见probe_source
+    :param codec: 其它分辨率使用的编码格式，同一个自适应集中的视频流编码格式需一致
+    :return: 可以直接复制的分辨率，没有时返回None
+    """
+    if probe.get('videoCodec') != codec or probe.get('pixFmt') != 'yuv420p':
+        return None
+    interval = probe.get('keyframeInterval')
+    if not probe.get('keyframeRegular') or not interval or interval > SEG_DURATION:
+        return None
+    if abs(SEG_DURATION / interval - round(SEG_DURATION / interval)) > 0.01:
+        return None
+    bit_rate = probe.get('videoBitRate') or probe.get('bitRate')
+    for resolution, bitrate in ladder:
+        if resolution == f"{probe['width']}x{probe['height']}" and bit_rate and \
+                bit_rate <= parse_bitrate(bitrate) * STREAM_COPY_BITRATE_TOLERANCE:
+            return resolution
+    return None
+
+
+def measure_complexity(input_path: str, duration: float, work_dir: str, samples: int = 4,
+                       sample_duration: float = 4, encoder: EncoderProfile = None) -> float:
+    """
+    以恒定质量参数试编码均匀分布的若干采样片段，估算画面复杂度
+
+    恒定质量下画面越复杂、运动越剧烈，所需码率越高，因此以640x360下的平均码率(bit/s)作为复杂度
+    """
+    encoder = encoder or select_encoder()
+    sample_duration = min(sample_duration, duration)
+    os.makedirs(work_dir, exist_ok=True)
+    total_size = 0
+    for i in range(samples):
+        start = max(duration * (i + 0.5) / samples - sample_duration / 2, 0)
+        output_path = os.path.join(work_dir, f'complexity_{i}.mp4')
+        stream = ffmpeg.input(input_path, ss=start, t=sample_duration, **encoder.input_kwargs()).video \
+            .filter('scale', '640x360').output(output_path, **encoder.output_kwargs())
+        run_ffmpeg(stream)
+        total_size += os.path.getsize(output_path)
+        os.remove(output_path)
+    return total_size * 8 / (sample_duration * samples)
+
+
+def get_pixel_count(resolution: str) -> int:
+    width, height = resolution.split('x')
+    return int(width) * int(height)
+
+
+def rendition_fingerprint(source_hash: str, resolution: str, bitrate: str, encoder: EncoderProfile) -> str:
+    """
+    由源视频内容哈希和规范化后的编码参数计算分辨率输出的指纹，指纹相同的输出内容相同，可直接复用
+
+    线程数只影响编码速度，不计入指纹
+    """
+    params = {key: value for key, value in encoder.output_kwargs([bitrate]).items() if key != 'threads'}
+    params.update(resolution=resolution, dar='16/9', keyframeInterval=SEG_DURATION)
+    normalized = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(f'{source_hash}:{normalized}'.encode()).hexdigest()[:16]
+
+
+def get_rendition_path(work_dir: str, resolution: str, fingerprint: str) -> str:
+    return os.path.join(work_dir, f'rendition_{resolution}_{fingerprint}.mp4')
+
+
+def encode_renditions(input_path: str, outputs: Sequence[Tuple[str, str, str]], encoder: EncoderProfile = None,
+                      on_progress: ProgressCallback = None, threads: int = None, filter_threads: int = None,
+                      thumbnail_dir: str = None):
+    """
+    只解码一次输入视频，通过split滤镜分出各分辨率分支，每个分支编码为一个只含视频流的mp4
+
+    所有分支按固定时间间隔强制插入关键帧，保证各分辨率的分片边界对齐，播放器可以在任意分片处切换码率。
+    编码结果先写入临时文件，全部成功后才改名，存在的输出文件一定是完整的
+    :param outputs: 依次为(分辨率, 视频码率, 输出路径)
+    :param encoder: 编码配置，默认按当前机器可用的编码器自动选择
+    :param on_progress: 进度回调
+    :param threads: 本次编码可用的线程总数，在各分支的编码器间平均分配，为None时使用编码配置的默认值
+    :param filter_threads: 缩放等滤镜使用的线程数，为None时由ffmpeg按核数决定
+    :param thumbnail_dir: 同时输出进度条预览雪碧图的目录，从最低分辨率的分支再分出一路截取，几乎不增加开销
+    """
+    encoder = encoder or select_encoder()
+    input_ = ffmpeg.input(input_path, **encoder.input_kwargs())
+    branches = input_.video.filter_multi_output('split', len(outputs))
+    lowest = min(range(len(outputs)), key=lambda i: get_pixel_count(outputs[i][0]))
+    output_list = []
+    for i, (resolution, bitrate, output_path) in enumerate(outputs):
+        video = branches.stream(i).filter('scale', resolution).filter('setdar', '16/9')
+        if thumbnail_dir is not None and i == lowest:
+            low_res = video.filter_multi_output('split', 2)
+            video = low_res.stream(0)
+            output_list.append(thumbnail_output(low_res.stream(1), thumbnail_dir + '.tmp'))
+        output_kwargs = encoder.output_kwargs([bitrate])
+        if threads is not None and not encoder.is_hardware:
+            output_kwargs['threads'] = max(threads // len(outputs), 1)
+        output_list.append(video.output(output_path + '.tmp', f='mp4',
+                                        force_key_frames=f'expr:gte(t,n_forced*{SEG_DURATION})',
+                                        **output_kwargs))
+    stream_spec = ffmpeg.merge_outputs(*output_list)
+    if filter_threads is not None:
+        stream_spec = stream_spec.global_args('-filter_complex_threads', str(filter_threads))
+    if thumbnail_dir is not None:
+        shutil.rmtree(thumbnail_dir + '.tmp', ignore_errors=True)
+        os.makedirs(thumbnail_dir + '.tmp')
+    run_ffmpeg(stream_spec, on_progress)
+    for _, _, output_path in outputs:
+        os.replace(output_path + '.tmp', output_path)
+    if thumbnail_dir is not None:
+        replace_dir(thumbnail_dir + '.tmp', thumbnail_dir)
+
+
+def replace_dir(src: str, dst: str):
+    shutil.rmtree(dst, ignore_errors=True)
+    os.replace(src, dst)
+
+
+def get_thumbnail_dir(mpd_path: str) -> str:
+    return os.path.join(os.path.dirname(mpd_path), 'thumbnails')
+
+
+def thumbnail_output(stream, output_dir: str):
+    """每隔THUMBNAIL_INTERVAL秒取一帧，缩小后按THUMBNAIL_TILE拼成雪碧图"""
+    width, height = THUMBNAIL_SIZE
+    columns, rows = THUMBNAIL_TILE
+    return (stream.filter('fps', f'1/{THUMBNAIL_INTERVAL}')
+            .filter('scale', width, height)
+            .filter('tile', f'{columns}x{rows}')
+            .output(os.path.join(output_dir, THUMBNAIL_SPRITE_PATTERN), f='image2', **{'q:v': 5}))
+
+
+def generate_thumbnails(input_path: str, thumbnail_dir: str, on_progress: ProgressCallback = None):
+    """
+    单独生成进度条预览雪碧图，用于没有经过encode_renditions的视频(如分段并行转码)
+
+    只解码关键帧，截取的画面取最近的关键帧，开销远小于完整解码
+    """
+    shutil.rmtree(thumbnail_dir + '.tmp', ignore_errors=True)
+    os.makedirs(thumbnail_dir + '.tmp')
+    stream = ffmpeg.input(input_path, skip_frame='nokey').video
+    run_ffmpeg(thumbnail_output(stream, thumbnail_dir + '.tmp'), on_progress)
+    replace_dir(thumbnail_dir + '.tmp', thumbnail_dir)
+
+
+def _format_vtt_time(seconds: float) -> str:
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}'
+
+
+def write_thumbnail_vtt(thumbnail_dir: str, duration: float) -> Tuple[str, List[str]]:
+    """
+    为thumbnail_dir中的雪碧图生成WebVTT缩略图索引，每条cue对应一张缩略图在雪碧图中的位置(#xywh)
+
+    :return: (vtt文件路径, 按顺序排列的雪碧图路径)
+    """
+    sprites = sorted(glob.glob(os.path.join(thumbnail_dir, THUMBNAIL_SPRITE_PATTERN.replace('%03d', '*'))))
+    width, height = THUMBNAIL_SIZE
+    columns, rows = THUMBNAIL_TILE
+    lines = ['WEBVTT', '']
+    for i in range(min(math.ceil(duration / THUMBNAIL_INTERVAL), len(sprites) * columns * rows)):
+        sprite, index = divmod(i, columns * rows)
+        x, y = index % columns * width, index // columns * height
+        start, end = i * THUMBNAIL_INTERVAL, min((i + 1) * THUMBNAIL_INTERVAL, duration)
+        lines.append(f'{_format_vtt_time(start)} --> {_format_vtt_time(end)}')
+        # 雪碧图与vtt位于同一目录，使用相对路径，内容相同的视频可共用
+        lines.append(f'{os.path.basename(sprites[sprite])}#xywh={x},{y},{width},{height}')
+        lines.append('')
+    vtt_path = os.path.join(thumbnail_dir, THUMBNAIL_VTT_NAME)
+    with open(vtt_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+    return vtt_path, sprites
+
+
+def get_audio_path(work_dir: str) -> str:
+    return os.path.join(work_dir, 'audio.m4a')
+
+
+def encode_audio(input_path: str, output_path: str, audio_codec: Optional[str] = None,
+                 on_progress: ProgressCallback = None):
+    """
+    将源视频的音轨单独输出为一个只含音频的m4a，所有分辨率共用这一条音轨
+
+    源音轨已是AAC时直接复制，否则编码一次为AAC
+    :param audio_codec: 源音轨的编码，见probe_source
+    """
+    codec_kwargs = {'c:a': 'copy'} if audio_codec == 'aac' else {'c:a': 'aac', 'b:a': AUDIO_BITRATE}
+    stream = ffmpeg.input(input_path).audio.output(output_path + '.tmp', f='mp4', **codec_kwargs)
+    run_ffmpeg(stream, on_progress)
+    os.replace(output_path + '.tmp', output_path)
+
+
+def get_hls_master_path(mpd_path: str) -> str:
+    return os.path.join(os.path.dirname(mpd_path), HLS_MASTER_NAME)
+
+
+def package_dash(video_streams: Sequence, mpd_path: str, audio_source: Optional[str] = None,
+                 on_progress: ProgressCallback = None):
+    """
+    不重新编码，将已编码的各分辨率视频流及共用的音轨以CMAF方式封装，所有分辨率引用同一个音频自适应集
+
+    同时输出mpd和同目录下的HLS主播放列表HLS_MASTER_NAME，二者共用同一组fMP4分片
+
+    :param audio_source: encode_audio输出的音轨，为None时只封装视频
+    """
+    # 音轨放在最前，视频流的序号不会因为音轨的有无而变化，分片文件名中的序号保持稳定
+    streams = [ffmpeg.input(audio_source).audio] if audio_source is not None else []
+    streams.extend(video_streams)
+    output_kwargs = {
+        'c:v': 'copy',
+        'seg_duration': SEG_DURATION,
+        'adaptation_sets': 'id=0,streams=v',
+        **CMAF_OUTPUT_KWARGS,
+        'f': 'dash',
+    }
+    if audio_source is not None:
+        output_kwargs['c:a'] = 'copy'
+        output_kwargs['adaptation_sets'] = 'id=0,streams=v id=1,streams=a'
+    run_ffmpeg(ffmpeg.output(*streams, mpd_path, **output_kwargs), on_progress)
+
+
+def split_source(input_path: str, work_dir: str, segment_time: int, on_progress: ProgressCallback = None) -> List[str]:
+    """
+    不重新编码，将源视频按约segment_time秒切成若干段
+
+    流复制只能在关键帧处切分，每段实际从segment_time之后的第一个关键帧开始，各段首尾相接、不重叠。
+    只保留视频流，音轨由encode_audio整体处理一次，避免分段编码AAC在拼接处产生的间隙
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    run_ffmpeg(ffmpeg.input(input_path).output(
+        os.path.join(work_dir, 'part_%04d.mkv'),
+        map='0:v:0', c='copy', f='segment', segment_time=segment_time, reset_timestamps=1,
+    ), on_progress)
+    return sorted(glob.glob(os.path.join(work_dir, 'part_*.mkv')))
+
+
+def transcode_segment(part_path: str, output_dir: str, source_id: str,
+                      ladder: Sequence[Tuple[str, str]] = DEFAULT_LADDER, encoder: EncoderProfile = None,
+                      copy_resolution: str = None, threads: int = None, filter_threads: int = None) -> List[str]:
+    """
+    将一段视频一次解码、按分辨率阶梯编码为各分辨率的视频文件
+
+    输出文件名带有编码参数的指纹，重试或重新切分后已存在的输出直接复用，只编码缺少的分辨率
+    :param output_dir: 输出目录，与分段文件分开存放，清理分段文件时保留编码结果
+    :param source_id: 分段内容的标识，相同源视频按相同时长切分时同一序号的分段内容相同，
+                      由源视频内容哈希、切分时长和分段序号组成
+    :param copy_resolution: 直接复制源视频流的分辨率，见find_stream_copy_rung，该分辨率直接使用分段文件本身
+    :param threads: 见encode_renditions
+    :param filter_threads: 见encode_renditions
+    :return: 与ladder一一对应的输出文件路径
+    """
+    encoder = encoder or select_encoder()
+    os.makedirs(output_dir, exist_ok=True)
+    part_name = os.path.splitext(os.path.basename(part_path))[0]
+    outputs = [(resolution, bitrate, os.path.join(
+                    output_dir,
+                    f'{part_name}_{resolution}_{rendition_fingerprint(source_id, resolution, bitrate, encoder)}.mp4'))
+               for resolution, bitrate in ladder if resolution != copy_resolution]
+    pending = [output for output in outputs if not os.path.exists(output[2])]
+    if pending:
+        encode_renditions(part_path, pending, encoder, threads=threads, filter_threads=filter_threads)
+    output_paths = {resolution: output_path for resolution, _, output_path in outputs}
+    return [output_paths.get(resolution, part_path) for resolution, _ in ladder]
+
+
+def stitch_to_dash(segment_outputs: Sequence[Sequence[str]], mpd_path: str, audio_source: Optional[str] = None,
+                   on_progress: ProgressCallback = None):
+    """
+    按顺序拼接各段的编码结果，不重新编码视频，与共用的音轨一起封装为DASH
+
+    :param segment_outputs: 每段的编码结果，即各段transcode_segment的返回值
+    :param audio_source: encode_audio输出的音轨，为None时只封装视频
+    """
+    # 各段输出可能位于不同目录(直接复制的分辨率使用分段文件本身)，文件列表写入临时目录，使用绝对路径
+    with tempfile.TemporaryDirectory() as list_dir:
+        streams = []
+        for i in range(len(segment_outputs[0])):
+            # concat demuxer的文件列表，每个分辨率一份
+            list_path = os.path.join(list_dir, f'concat_{i}.txt')
+            with open(list_path, 'w') as f:
+                for outputs in segment_outputs:
+                    f.write("file '{0}'\n".format(os.path.abspath(outputs[i]).replace("'", "'\\''")))
+            streams.append(ffmpeg.input(list_path, f='concat', safe=0).video)
+        package_dash(streams, mpd_path, audio_source, on_progress)
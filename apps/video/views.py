@@ -1,26 +1,30 @@
 # Create your views here.
 import base64
+import json
 import os.path
+import re
 import subprocess
 import uuid
 
 from datetime import timedelta
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models
 from django.db.models.functions import TruncDate
 from django.db.models.expressions import RawSQL
 from django.db.models import Sum, Count
-from django.http import JsonResponse
+from django.http import JsonResponse, UnreadablePostError
 from django.utils.decorators import method_decorator
 from django_filters import rest_framework as filters
 from django.core.cache import cache
+from django.core.files.uploadhandler import MemoryFileUploadHandler
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.request import Request
 
-from apps.video.models import Video, StatusEnum
+from apps.video.models import MediaObject, Video, StatusEnum
+from apps.video.progress import get_progress
 from apps.video.service import VideoUploadService
 from utils.paginator import AppPageNumberPagination
 from utils.queryset_filter import VideoFilter
@@ -29,6 +33,8 @@ from utils.serializer import VideoSerializer
 from openai import OpenAI
 
 from apps.video import tasks
+from service.multipart_file_upload import ChunkTruncatedError
+from service.upload_handlers import ChunkTemporaryFileUploadHandler, RequestBodyChunk
 
 MEDIA_ROOT = settings.MEDIA_ROOT
 
@@ -110,10 +116,12 @@ class VideoViewSet(viewsets.ModelViewSet):
     @swagger_auto_schema(
         tags=["手术视频相关接口"],
         operation_summary="查询手术视频记录",
-        operation_description="**查询某一条手术视频记录**"
+        operation_description="**查询某一条手术视频记录**，转码中的视频额外返回转码进度transcodeProgress，"
+                              "包括阶段stage、完成百分比percent、帧率fps、速度speed、预计剩余秒数eta和更新时间updatedAt"
     )
     def retrieve(self, request, *args, **kwargs):
         response = super().retrieve(request, *args, **kwargs)
+        response.data['transcodeProgress'] = get_progress(response.data['videoId'])
         return JsonResponse(data=response.data)
 
     @swagger_auto_schema(
@@ -150,7 +158,9 @@ class VideoViewSet(viewsets.ModelViewSet):
                                           default='.mp4'),
                 'chunkName': openapi.Schema(type=openapi.TYPE_STRING,
                                             description="分片文件的名称，以`-`分隔，前半部分为`fileHash`，后半部分为本切片在整个视频中所处的位置序号",
-                                            default="b4cd45e94e80e13c7407d87ad3d5358e-1")
+                                            default="b4cd45e94e80e13c7407d87ad3d5358e-1"),
+                'chunkHash': openapi.Schema(type=openapi.TYPE_STRING,
+                                            description="可选，分片内容的MD5，提供时服务端写入后立即校验，不一致则拒绝本分片")
             }
         ),
         responses={
@@ -170,20 +180,78 @@ class VideoViewSet(viewsets.ModelViewSet):
     )
     @action(methods=['post'], detail=False, url_path='uploadChunk')
     def upload_chunk(self, request: Request, *args, **kwargs):
+        # 较大的切片直接落盘到切片目录所在的文件系统，而不是系统临时目录，写入切片时只需重命名
+        request._request.upload_handlers = [MemoryFileUploadHandler(request._request),
+                                            ChunkTemporaryFileUploadHandler(request._request)]
         chunk = request.FILES.get('chunk')
         file_hash = request.data.get('fileHash')
         file_ext = request.data.get('fileExt')
         chunk_name = request.data.get('chunkName')
+        chunk_hash = request.data.get('chunkHash')
 
-        self.video_upload_service.upload_file_chunk(chunk, chunk_name, file_hash, file_ext)
+        return self._save_chunk(chunk, chunk_name, file_hash, file_ext, chunk_hash)
 
+    def _save_chunk(self, chunk, chunk_name: str, file_hash: str, file_ext: str, chunk_hash: str):
+        """切片校验失败或内容不完整时返回400，客户端据此重新发送该切片"""
+        try:
+            self.video_upload_service.upload_file_chunk(chunk, chunk_name, file_hash, file_ext, chunk_hash)
+        except (ValueError, ChunkTruncatedError, UnreadablePostError) as e:
+            return JsonResponse(code=400, success=False, msg=f'chunk {chunk_name} failed verification: {e}',
+                                status=status.HTTP_400_BAD_REQUEST)
         return JsonResponse()
 
+    @swagger_auto_schema(
+        tags=["手术视频相关接口"],
+        methods=['put', 'post'],
+        operation_summary="以二进制流上传手术视频分片",
+        operation_description="**请求体为分片的原始内容(`application/octet-stream`)，分片信息通过查询参数传递，"
+                              "服务端边接收边写入分片的最终位置，不经过临时文件**",
+        manual_parameters=[
+            openapi.Parameter('fileHash', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True,
+                              description="手术视频文件计算得到的哈希值，用于区分不同的视频"),
+            openapi.Parameter('fileExt', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True,
+                              description="手术视频文件的扩展名，如.mp4"),
+            openapi.Parameter('chunkName', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True,
+                              description="分片文件的名称，以`-`分隔，前半部分为`fileHash`，后半部分为本切片在整个视频中所处的位置序号"),
+            openapi.Parameter('chunkHash', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description="可选，分片内容的MD5，提供时服务端写入后立即校验，不一致则拒绝本分片"),
+        ],
+        responses={
+            200: openapi.Response(
+                description='ok',
+                schema=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        'success': openapi.Schema(type=openapi.TYPE_BOOLEAN, default=True),
+                        'code': openapi.Schema(type=openapi.TYPE_NUMBER, default=200),
+                        'msg': openapi.Schema(type=openapi.TYPE_STRING, default='成功'),
+                        'data': openapi.Schema(type=openapi.TYPE_STRING, default='')
+                    }
+                )
+            )
+        },
+    )
+    @action(methods=['put', 'post'], detail=False, url_path='uploadChunkRaw')
+    def upload_chunk_raw(self, request: Request, *args, **kwargs):
+        file_hash = request.query_params.get('fileHash')
+        file_ext = request.query_params.get('fileExt')
+        chunk_name = request.query_params.get('chunkName')
+        chunk_hash = request.query_params.get('chunkHash')
+        content_length = request.META.get('CONTENT_LENGTH')
+        if not content_length:
+            return JsonResponse(code=411, success=False, msg='Content-Length is required',
+                                status=status.HTTP_411_LENGTH_REQUIRED)
+
+        # 不访问request.data，直接读取原始请求体
+        chunk = RequestBodyChunk(request.stream, int(content_length))
+        return self._save_chunk(chunk, chunk_name, file_hash, file_ext, chunk_hash)
+
     # noinspection PyTypeChecker
     @swagger_auto_schema(
         tags=["手术视频相关接口"],
         operation_summary="合并手术视频分片",
-        operation_description="**将之前上传的手术视频分段合并为完整的手术视频，并进行去雾、转码等操作**",
+        operation_description="**创建手术视频记录后立即返回，在后台将之前上传的手术视频分段合并为完整的手术视频，并进行去雾、转码等操作，"
+                              "处理进度见返回记录的`jobStatus`字段**",
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
             required=['fileHash', 'fileExt', 'fileName'],
@@ -199,7 +267,7 @@ class VideoViewSet(viewsets.ModelViewSet):
             }
         ),
         responses={
-            200: VideoSerializer
+            202: VideoSerializer
         }
     )
     @action(methods=['post'], detail=False, url_path='mergeChunk')
@@ -209,29 +277,90 @@ class VideoViewSet(viewsets.ModelViewSet):
         file_name = request.data.get('fileName')
         course_id = request.data.get('courseId')
 
-        origin_path = self.video_upload_service.merge_file_chunk(file_hash, file_ext)
-        target_path = self.video_upload_service.move_to_db_dictionary(origin_path)
-        mpd_path = self.video_upload_service.generate_mpd_path(target_path, file_hash)
-        poster_path = self.video_upload_service.generate_poster_path(target_path, file_hash)
+        if not self.video_upload_service.is_upload_complete(file_hash, file_ext):
+            return JsonResponse(code=400, success=False, msg='chunks have not been uploaded completely',
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        # 客户端超时重试或并发提交时返回已有记录，共用同一个转码任务
+        existing_video = Video.objects.filter(fileHash=file_hash, courseId=course_id).first()
+        if existing_video is not None:
+            return self._resume_merge(existing_video, file_ext)
+
         video_id = f'vid_{file_hash}_{uuid.uuid4().hex[:8]}'
+        target_path, mpd_path, poster_path = self.video_upload_service.generate_video_paths(file_hash, file_ext,
+                                                                                            video_id)
         video_data = {
             "videoId": video_id,
             "videoName": file_name,
             "videoUrl": os.path.relpath(mpd_path, MEDIA_ROOT),
             "coverImgUrl": os.path.relpath(poster_path, MEDIA_ROOT),
             "courseId": course_id,
-            "status": StatusEnum.PROCESSING.value
+            "fileHash": file_hash,
+            "status": StatusEnum.UPLOADING.value,
+            "metadata": {"job": {"stage": "queued"}}
         }
         serializer = self.get_serializer(data=video_data)
         serializer.is_valid(raise_exception=True)
-        # step0 为视频生成首帧封面
-        self.video_upload_service.generate_video_poster(target_path, poster_path)
-        # 先更新数据库，再视频后处理
-        self.perform_create(serializer)
+        # 先创建记录，合并、封面、转码等耗时操作均在后台完成，客户端通过jobStatus查询进度
+        try:
+            self.perform_create(serializer)
+        except IntegrityError:
+            # 并发提交时只有一个请求能创建成功
+            return self._resume_merge(Video.objects.get(fileHash=file_hash, courseId=course_id), file_ext)
         headers = self.get_success_headers(serializer.data)
-        # self.video_upload_service.video_process(target_path, mpd_path, poster_path, video_id, self)
-        tasks.video_process(target_path, mpd_path, video_id)
-        return JsonResponse(data=serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+        tasks.ingest_video.delay(video_id, file_hash, file_ext)
+        return JsonResponse(data=serializer.data, status=status.HTTP_202_ACCEPTED, headers=headers)
+
+    def _resume_merge(self, video: Video, file_ext: str):
+        """重复的合并请求返回已有记录，仅当之前的后台任务失败时才重新入库"""
+        job = (video.metadata or {}).get('job', {})
+        if video.status == StatusEnum.UNKNOWN.value and job.get('stage') == 'failed':
+            video.status = StatusEnum.UPLOADING.value
+            video.metadata = {**video.metadata, 'job': {'stage': 'queued'}}
+            video.save()
+            tasks.ingest_video.delay(video.videoId, video.fileHash, file_ext)
+        serializer = self.get_serializer(video)
+        return JsonResponse(data=serializer.data, status=status.HTTP_202_ACCEPTED)
+
+    @staticmethod
+    def _parse_size(data, name: str):
+        """可选的字节数参数，未提供时返回None，不是正整数时抛出ValueError"""
+        value = data.get(name)
+        if value is None or value == '':
+            return None
+        try:
+            size = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{name} must be an integer') from None
+        if size <= 0:
+            raise ValueError(f'{name} must be positive')
+        return size
+
+    @staticmethod
+    def _parse_chunk_hashes(data):
+        """
+        可选的各切片MD5，接受json数组、表单中重复的字段，或逗号分隔的字符串，空字符串表示不校验该切片
+
+        :return: 切片序号到MD5的映射，未提供时返回None，格式错误时抛出ValueError
+        """
+        value = data.getlist('chunkHashes') if hasattr(data, 'getlist') else data.get('chunkHashes')
+        if isinstance(value, list) and len(value) == 1 and isinstance(value[0], str):
+            value = value[0]
+        if isinstance(value, str):
+            value = value.strip()
+            if value.startswith('['):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    raise ValueError('chunkHashes is not a valid json array') from None
+            else:
+                value = value.split(',') if value else []
+        if value is None or value == []:
+            return None
+        if not isinstance(value, list) or not all(
+                isinstance(item, str) and re.fullmatch(r'([0-9a-fA-F]{32})?', item.strip()) for item in value):
+            raise ValueError('chunkHashes must be a list of md5 hex strings')
+        return {i: item.strip().lower() for i, item in enumerate(value) if item.strip()} or None
 
     @swagger_auto_schema(
         tags=["手术视频相关接口"],
@@ -245,7 +374,19 @@ class VideoViewSet(viewsets.ModelViewSet):
                                            description="手术视频文件计算得到的哈希值，用于区分不同的视频",
                                            default='b4cd45e94e80e13c7407d87ad3d5358e'),
                 'fileExt': openapi.Schema(type=openapi.TYPE_STRING, description="手术视频文件的扩展名，如.mp4",
-                                          default='.mp4')
+                                          default='.mp4'),
+                'totalSize': openapi.Schema(type=openapi.TYPE_INTEGER,
+                                            description="可选，手术视频文件的总字节数，与`chunkSize`同时提供时服务端预分配文件，"
+                                                        "切片直接写入对应偏移量，合并时无需再次拷贝"),
+                'chunkSize': openapi.Schema(type=openapi.TYPE_INTEGER,
+                                            description="可选，除最后一个切片外每个切片的字节数"),
+                'compact': openapi.Schema(type=openapi.TYPE_BOOLEAN, default=False,
+                                          description="可选，为true时不返回`uploadedList`，只返回切片序号区间"),
+                'chunkHashes': openapi.Schema(type=openapi.TYPE_ARRAY,
+                                              items=openapi.Schema(type=openapi.TYPE_STRING),
+                                              description="可选，按切片序号排列的各切片MD5，提供时服务端逐一校验已接收的切片，"
+                                                          "只返回校验通过的切片，客户端续传时只需重新发送其余切片；"
+                                                          "表单提交时可为逗号分隔的字符串，空字符串表示不校验该切片")
             }
         ),
         responses={
@@ -265,7 +406,17 @@ class VideoViewSet(viewsets.ModelViewSet):
                             'uploadedList': openapi.Schema(
                                 type=openapi.TYPE_ARRAY,
                                 items=openapi.Schema(type=openapi.TYPE_STRING, default='chunk-1'),
-                                description='此视频文件已在服务器存在的部分切片，客户端应当上传其余的切片')
+                                description='此视频文件已在服务器存在的部分切片，客户端应当上传其余的切片'),
+                            'uploadedRanges': openapi.Schema(
+                                type=openapi.TYPE_ARRAY,
+                                items=openapi.Schema(type=openapi.TYPE_ARRAY,
+                                                     items=openapi.Schema(type=openapi.TYPE_INTEGER)),
+                                description='已上传切片序号的闭区间列表，如[[0, 99], [150, 200]]'),
+                            'missingRanges': openapi.Schema(
+                                type=openapi.TYPE_ARRAY,
+                                items=openapi.Schema(type=openapi.TYPE_ARRAY,
+                                                     items=openapi.Schema(type=openapi.TYPE_INTEGER)),
+                                description='尚未上传切片序号的闭区间列表，仅在声明了`totalSize`和`chunkSize`时返回')
                         })
                     }
                 )
@@ -276,7 +427,15 @@ class VideoViewSet(viewsets.ModelViewSet):
     def verify_upload(self, request: Request, *args, **kwargs):
         file_hash = request.data.get('fileHash')
         file_ext = request.data.get('fileExt')
-        res = self.video_upload_service.verify_should_upload(file_hash, file_ext)
+        try:
+            total_size = self._parse_size(request.data, 'totalSize')
+            chunk_size = self._parse_size(request.data, 'chunkSize')
+            chunk_hashes = self._parse_chunk_hashes(request.data)
+        except ValueError as e:
+            return JsonResponse(code=400, success=False, msg=str(e), status=status.HTTP_400_BAD_REQUEST)
+        compact = request.data.get('compact') in (True, 'true', '1')
+        res = self.video_upload_service.verify_should_upload(file_hash, file_ext, total_size, chunk_size, compact,
+                                                             chunk_hashes)
         return JsonResponse(data=res)
 
     # Create a function to handle the POST request
@@ -311,19 +470,36 @@ class VideoViewSet(viewsets.ModelViewSet):
         # Get the file path of the video
         video_url = video.coverImgUrl.replace('poster.png', '640x360.mp4')
         video_file_path = os.path.join(settings.MEDIA_ROOT, video_url)
+        scale_args = []
+        metadata = video.metadata or {}
+        rendition_url = metadata.get('stages', {}).get('encode', {}).get('640x360')
+        media_object = MediaObject.objects.filter(fileHash=video.fileHash).first() if video.fileHash else None
+        if rendition_url and os.path.exists(os.path.join(settings.MEDIA_ROOT, rendition_url)):
+            # 转码流水线保留的640x360编码结果
+            video_file_path = os.path.join(settings.MEDIA_ROOT, rendition_url)
+        elif not os.path.exists(video_file_path) and media_object is not None:
+            # 直接转为DASH的视频没有640x360的mp4，从源视频截取后缩放
+            video_file_path = os.path.join(settings.MEDIA_ROOT, media_object.filePath)
+            scale_args = ["-vf", "scale=640:360"]
 
         # Generate a unique filename for the extracted frame
         output_image_path = f"{str(uuid.uuid4())}.jpg"
 
         # Use ffmpeg to extract the frame at the specified play_time
-        if 0 < float(play_time) < 10:
+        play_time = float(play_time)
+        duration = metadata.get('probe', {}).get('duration')
+        if 0 < play_time < 10 and (duration is None or duration > 10):
             play_time = 10
+        if duration is not None and play_time >= duration:
+            # 超出视频时长时截取最后一秒的画面
+            play_time = max(duration - 1, 0)
         try:
             subprocess.run(
                 [
                     "ffmpeg",
                     "-ss", str(play_time),
                     "-i", video_file_path,
+                    *scale_args,
                     "-vframes", "1",
                     "-q:v", "2",  # Highest quality JPEG
                     output_image_path
@@ -68,4 +68,12 @@ CELERY_TIMEZONE = 'Asia/Shanghai'
 # 指定导入的任务模块，可以指定多个
 CELERY_IMPORTS = (
    'apps.video.tasks',
-)
\ No newline at end of file
+)
+
+# 缓存配置，web进程与celery worker共用，转码进度等需要跨进程读取的数据通过缓存传递
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+    }
+}
@@ -13,8 +13,9 @@ tmp_path = os.path.join(os.path.join(base_path, 'resource'), 'tmp')
 
 
 class DefogModel:
-    def __init__(self, video_path):
-        self.fps = None
+    def __init__(self, video_path, fps=None):
+        # 已知帧率时传入，可省去一次probe
+        self.fps = fps
         self.video_path = video_path
         self.video_save_path = os.path.dirname(video_path)
         self.checkpoint_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cho.ckpt')
@@ -30,9 +31,10 @@ class DefogModel:
         self.ndf = 64
 
     def video2image(self):
-        info = ffmpeg.probe(self.video_path)
-        vs = next(c for c in info['streams'] if c['codec_type'] == 'video')
-        self.fps = float(Fraction(vs['r_frame_rate']))
+        if self.fps is None:
+            info = ffmpeg.probe(self.video_path)
+            vs = next(c for c in info['streams'] if c['codec_type'] == 'video')
+            self.fps = float(Fraction(vs['r_frame_rate']))
         if not os.path.exists(self.dataset_dir):
             os.makedirs(self.dataset_dir)
         try:
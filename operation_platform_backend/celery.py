@@ -1,6 +1,7 @@
 from __future__ import absolute_import , unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
 from django.conf import settings
 
 # 设置系统环境变量，安装django，必须设置，否则在启动celery时会报错
@@ -11,3 +12,33 @@ celery_app.config_from_object('django.conf:settings')
 celery_app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 celery_app.conf.worker_concurrency = 8
 celery_app.conf.worker_max_tasks_per_child = 100
+
+# 转码任务耗时长、占满CPU，单独使用transcode队列，由专门的worker执行，入库、封面、清理等轻量任务留在默认队列，
+# 不会排在转码任务之后；转码worker上同时执行的ffmpeg数另由apps.video.scheduler按节点资源限制
+celery_app.conf.task_routes = {
+    'apps.video.tasks.video_process': {'queue': 'transcode'},
+    'apps.video.tasks.transcode_video_segment': {'queue': 'transcode'},
+    'apps.video.tasks.stitch_segments': {'queue': 'transcode'},
+}
+
+# 定期清理被放弃的上传切片，需要同时启动celery beat
+celery_app.conf.beat_schedule = {
+    'sweep-upload-tmp': {
+        'task': 'apps.video.tasks.sweep_upload_tmp',
+        'schedule': 60 * 60,
+    },
+}
+
+
+@worker_init.connect
+def probe_video_encoders(**kwargs):
+    """worker主进程启动时探测一次可用的编码器并写入缓存文件，避免各子进程同时试编码超出显卡的编码会话数"""
+    from apps.video.encoders import load_available_encoders
+    load_available_encoders(refresh=True)
+
+
+@worker_process_init.connect
+def load_video_encoders(**kwargs):
+    """子进程启动时读取主进程的探测结果，转码任务直接使用"""
+    from apps.video.encoders import probe_encoders
+    probe_encoders()
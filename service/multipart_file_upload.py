@@ -1,26 +1,141 @@
+import errno
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import time
 
 from django.conf import settings
 from django.core.files.uploadedfile import UploadedFile
 
+from service.streaming_hash import FileHashState, ResumableMd5
+from service.upload_manifest import CHUNK_VERIFIED, UploadManifest, to_ranges
+
 # from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
 
 TMP_UPLOAD_ROOT = settings.TMP_UPLOAD_ROOT
 MIDEA_ROOT = settings.MEDIA_ROOT
 # tmp_upload_root = r'F:\resource\target'
 IO_SIZE = 1024 * 1024  # 每次IO操作1mb数据
+KERNEL_COPY_SIZE = 1024 * 1024 * 1024  # 内核态拷贝时每次系统调用最多拷贝1gb数据
+
+# 内核态拷贝出现以下错误时说明当前系统或文件系统不支持，退回到下一种拷贝方式
+_KERNEL_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+
+class ChunkTruncatedError(IOError):
+    """直接读取请求体时客户端中途断开，收到的切片内容不完整"""
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, count: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, count)
+
+
+def _sendfile(src_fd: int, dst_fd: int, count: int) -> int:
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+
+_KERNEL_COPY_FUNCS = []
+if hasattr(os, 'copy_file_range'):
+    _KERNEL_COPY_FUNCS.append(_copy_file_range)
+if hasattr(os, 'sendfile'):
+    _KERNEL_COPY_FUNCS.append(_sendfile)
+
+
+def pwrite_all(fd: int, data: bytes, offset: int) -> None:
+    """在指定偏移量写入全部数据，pwrite可能只写入部分数据，需要循环写入"""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def copy_stream(read_stream, write_stream, use_kernel_copy: bool = True) -> None:
+    """
+    将read_stream从当前位置到末尾的内容写入write_stream的当前位置
+
+    优先使用copy_file_range/sendfile在内核态完成拷贝，数据不经过用户态；
+    系统或文件系统不支持时退回到按IO_SIZE读写的方式
+    :param read_stream: 以二进制模式打开的源文件
+    :param write_stream: 以二进制、非追加模式打开的目标文件
+    :param use_kernel_copy: 是否尝试内核态拷贝，为False时直接按IO_SIZE读写
+    """
+    if use_kernel_copy:
+        write_stream.flush()
+        src_fd, dst_fd = read_stream.fileno(), write_stream.fileno()
+        for kernel_copy in _KERNEL_COPY_FUNCS:
+            try:
+                while kernel_copy(src_fd, dst_fd, KERNEL_COPY_SIZE) > 0:
+                    pass
+                return
+            except OSError as e:
+                if e.errno not in _KERNEL_COPY_FALLBACK_ERRNOS:
+                    raise
+                # 内核态拷贝会同步推进两个文件的偏移量，中途失败时下一种方式从当前位置继续即可
+    while True:
+        data = read_stream.read(IO_SIZE)
+        if not data:
+            break
+        write_stream.write(data)
 
 
 class MultipartFileUploadService:
+    # 合并切片时是否尝试copy_file_range/sendfile内核态拷贝
+    use_kernel_copy = True
+    # 合并时是否校验客户端提供的fileHash与文件内容的MD5一致
+    verify_file_hash = True
 
     def _get_chunk_dir(self, file_hash: str):
         return os.path.join(TMP_UPLOAD_ROOT, f'chunkDir_{file_hash}')
 
+    def _get_chunk_path(self, file_hash: str, chunk_index: int):
+        return os.path.join(self._get_chunk_dir(file_hash), f'{file_hash}-{chunk_index}')
+
     def _get_file_path(self, file_hash: str, file_ext: str):
         return os.path.join(TMP_UPLOAD_ROOT, f"{file_hash}{file_ext}")
 
+    def _get_part_path(self, file_hash: str, file_ext: str):
+        return os.path.join(TMP_UPLOAD_ROOT, f"{file_hash}{file_ext}.part")
+
+    def _get_manifest_path(self, file_hash: str):
+        return os.path.join(TMP_UPLOAD_ROOT, f'manifest_{file_hash}')
+
+    def _get_hash_state_path(self, file_hash: str):
+        return os.path.join(TMP_UPLOAD_ROOT, f'hashState_{file_hash}')
+
+    def _load_manifest(self, file_hash: str):
+        """
+        读取切片清单，不存在任何上传进度时返回None
+
+        清单功能上线前已开始的上传只有切片目录，此时根据目录内容补建一次清单
+        """
+        manifest = UploadManifest.load(self._get_manifest_path(file_hash))
+        if manifest is not None:
+            return manifest
+        chunk_dir = self._get_chunk_dir(file_hash)
+        if not os.path.exists(chunk_dir):
+            return None
+        manifest = UploadManifest.ensure(self._get_manifest_path(file_hash))
+        for chunk_name in os.listdir(chunk_dir):
+            # 忽略正在写入的临时文件
+            if chunk_name.endswith('.tmp'):
+                continue
+            chunk_path = os.path.join(chunk_dir, chunk_name)
+            chunk_index = int(chunk_name.split('-')[-1])
+            if chunk_name != os.path.basename(self._get_chunk_path(file_hash, chunk_index)):
+                os.replace(chunk_path, self._get_chunk_path(file_hash, chunk_index))
+            manifest.mark_received(chunk_index, os.path.getsize(self._get_chunk_path(file_hash, chunk_index)))
+        return manifest
+
+    def _remove_upload_state(self, file_hash: str) -> None:
+        for path in (self._get_manifest_path(file_hash), self._get_hash_state_path(file_hash)):
+            if os.path.exists(path):
+                os.remove(path)
+
     def _get_upload_dir(self, root_path_prefix="tmp"):
         """
         获取应该存储到数据库中的目录位置
@@ -34,58 +149,325 @@ class MultipartFileUploadService:
         return os.path.join(MIDEA_ROOT, root_path_prefix, sub_dir)
 
     def get_uploaded_chunk_list(self, file_hash: str):
-        chunk_dir = self._get_chunk_dir(file_hash)
-        return os.listdir(chunk_dir) if os.path.exists(chunk_dir) else []
+        manifest = self._load_manifest(file_hash)
+        if manifest is None:
+            return []
+        return [f'{file_hash}-{index}' for index in manifest.received_indexes()]
+
+    def init_preallocated_upload(self, file_hash: str, file_ext: str, total_size: int, chunk_size: int) -> None:
+        """
+        开启偏移写入模式
+
+        预先分配与最终文件等大的<hash><ext>.part文件，之后每个切片直接写入index * chunk_size处，
+        合并时只需检查完整性并重命名，无需再次读写切片。重复调用时保留已上传的进度
+        :param total_size: 文件总大小，单位字节
+        :param chunk_size: 除最后一个切片外每个切片的大小，单位字节
+        """
+        if total_size <= 0 or chunk_size <= 0:
+            raise ValueError('total size and chunk size must be positive')
+        manifest = UploadManifest.load(self._get_manifest_path(file_hash))
+        if manifest is not None and (manifest.total_size, manifest.chunk_size) == (total_size, chunk_size):
+            return
+        if not os.path.exists(TMP_UPLOAD_ROOT):
+            os.makedirs(TMP_UPLOAD_ROOT)
+
+        with open(self._get_part_path(file_hash, file_ext), 'wb') as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, total_size)
+            except (AttributeError, OSError):
+                # 不支持fallocate的平台或文件系统上退化为稀疏文件
+                f.truncate(total_size)
+        UploadManifest.create(self._get_manifest_path(file_hash), total_size, chunk_size)
+
+    def _write_chunk_at_offset(self, chunk: UploadedFile, chunk_index: int, manifest: UploadManifest,
+                               file_hash: str, file_ext: str, on_data=None) -> None:
+        if not 0 <= chunk_index < manifest.chunk_count:
+            raise ValueError(f'chunk index {chunk_index} out of range')
+        offset = chunk_index * manifest.chunk_size
+        if chunk.size != min(manifest.chunk_size, manifest.total_size - offset):
+            raise ValueError(f'chunk {chunk_index} size mismatch')
+
+        end = offset + chunk.size
+        fd = os.open(self._get_part_path(file_hash, file_ext), os.O_WRONLY)
+        try:
+            for chunk_data in chunk.chunks():
+                pwrite_all(fd, chunk_data, offset)
+                offset += len(chunk_data)
+                if on_data is not None:
+                    on_data(chunk_data)
+        finally:
+            os.close(fd)
+        if offset != end:
+            # 直接读取请求体时客户端可能中途断开
+            raise ChunkTruncatedError(f'chunk {chunk_index} truncated')
+
+    def _iter_uploaded_chunk_data(self, manifest: UploadManifest, file_hash: str, file_ext: str, chunk_index: int):
+        """
+        读取已完整写入磁盘的切片内容，切片尚未上传时返回None
+        """
+        if not manifest.is_received(chunk_index):
+            return None
+        size = manifest.records[chunk_index][1]
+        if manifest.is_preallocated:
+            return self._iter_file_range(self._get_part_path(file_hash, file_ext), chunk_index * manifest.chunk_size,
+                                         size)
+        return self._iter_file_range(self._get_chunk_path(file_hash, chunk_index), 0, size)
+
+    def _iter_file_range(self, path: str, offset: int, size: int):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while size > 0:
+                data = f.read(min(IO_SIZE, size))
+                if not data:
+                    break
+                size -= len(data)
+                yield data
+
+    def _advance_file_hash(self, hash_state: FileHashState, manifest: UploadManifest, file_hash: str,
+                           file_ext: str) -> None:
+        """将已按序到达的后续切片计入哈希，处理先于前序切片到达的乱序切片"""
+        while True:
+            chunk_data_iter = self._iter_uploaded_chunk_data(manifest, file_hash, file_ext, hash_state.next_index)
+            if chunk_data_iter is None:
+                return
+            for data in chunk_data_iter:
+                hash_state.update(data)
+            hash_state.next_index += 1
+
+    def _check_file_hash(self, manifest: UploadManifest, file_hash: str, file_ext: str) -> None:
+        """
+        合并前校验文件内容与客户端提供的fileHash是否一致
+
+        哈希在上传过程中已增量计算，此时通常只剩少量乱序切片需要补算，无需再完整读取一遍文件
+        """
+        if not self.verify_file_hash or not ResumableMd5.available:
+            return
+        file_size = manifest.received_size()
+        with FileHashState(self._get_hash_state_path(file_hash)) as hash_state:
+            self._advance_file_hash(hash_state, manifest, file_hash, file_ext)
+            if hash_state.hashed_size != file_size:
+                # 切片序号不是从0开始等情况下无法增量计算，跳过校验
+                logger.warning('skip hash verification for %s, %d of %d bytes hashed', file_hash,
+                               hash_state.hashed_size, file_size)
+                return
+            digest = hash_state.md5.hexdigest()
+        if digest != file_hash.lower():
+            raise ValueError(f'file hash mismatch, expect {file_hash}, got {digest}')
+
+    def is_upload_complete(self, file_hash: str, file_ext: str) -> bool:
+        """所有切片是否均已上传，只读取清单，不合并"""
+        if os.path.exists(self._get_file_path(file_hash, file_ext)):
+            return True
+        manifest = self._load_manifest(file_hash)
+        return manifest is not None and manifest.chunk_count > 0 and manifest.missing_count() == 0
 
     def merge_file_chunk(self, file_hash: str, file_ext: str):
         file_path = self._get_file_path(file_hash, file_ext)
-        chunk_dir = self._get_chunk_dir(file_hash)
-        if not os.path.exists(chunk_dir):
+        manifest = self._load_manifest(file_hash)
+        if manifest is None:
+            if os.path.exists(file_path):
+                # 文件已合并过，秒传时直接使用
+                return file_path
             raise FileNotFoundError('chunk dictionary not exists.')
-        chunk_path_list = [(os.path.join(chunk_dir, chunk_name), int(chunk_name.split('-')[-1])) for chunk_name in
-                           os.listdir(chunk_dir)]
-        # 将切片按顺序排序，否则拼接的时候会错位
-        chunk_path_list.sort(key=lambda item: item[1])
-        with open(file_path, 'ab') as write_stream:
-            for chunk_path, chunk_index in chunk_path_list:
-                with open(chunk_path, 'rb') as read_stream:
-                    while True:
-                        data = read_stream.read(IO_SIZE)
-                        if not data:
-                            break
-                        write_stream.write(data)
+        missing = manifest.missing_count()
+        if missing:
+            raise FileNotFoundError(f'{missing} chunks have not been uploaded yet.')
+        self._check_file_hash(manifest, file_hash, file_ext)
+
+        if manifest.is_preallocated:
+            # 切片已写入最终位置，重命名即可
+            os.replace(self._get_part_path(file_hash, file_ext), file_path)
+            self._remove_upload_state(file_hash)
+            return file_path
+
+        # 清单中的切片序号已经有序，否则拼接的时候会错位
+        # copy_file_range不支持以追加模式打开的目标文件，因此使用wb模式，同时也避免残留的半成品文件被重复追加
+        with open(file_path, 'wb') as write_stream:
+            for chunk_index in manifest.received_indexes():
+                with open(self._get_chunk_path(file_hash, chunk_index), 'rb') as read_stream:
+                    copy_stream(read_stream, write_stream, self.use_kernel_copy)
 
         # 合并完成删除切片
-        shutil.rmtree(chunk_dir)
+        shutil.rmtree(self._get_chunk_dir(file_hash))
+        self._remove_upload_state(file_hash)
         return file_path
 
-    def upload_file_chunk(self, chunk: UploadedFile, chunk_name: str, file_hash: str, file_ext: str) -> None:
+    def upload_file_chunk(self, chunk: UploadedFile, chunk_name: str, file_hash: str, file_ext: str,
+                          chunk_hash: str = None) -> None:
+        """
+        :param chunk_hash: 可选，客户端计算的切片MD5，提供时写入后立即校验，不一致则拒绝本切片
+        """
         file_path = os.path.join(TMP_UPLOAD_ROOT, f"{file_hash}{file_ext}")
-
-        chunk_dir = self._get_chunk_dir(file_hash)
-        chunk_path = os.path.join(chunk_dir, chunk_name)
+        chunk_index = int(chunk_name.split('-')[-1])
+        expected_digest = bytes.fromhex(chunk_hash) if chunk_hash else None
 
         if os.path.exists(file_path):
             return
-        if os.path.exists(chunk_path):
+        manifest = self._load_manifest(file_hash)
+        if manifest is None:
+            os.makedirs(self._get_chunk_dir(file_hash), exist_ok=True)
+            manifest = UploadManifest.ensure(self._get_manifest_path(file_hash))
+        if not manifest.is_preallocated and manifest.is_received(chunk_index) and \
+                (expected_digest is None or manifest.get_digest(chunk_index) == expected_digest):
+            # 已接收的切片只有在与客户端校验值不一致时才重新写入
             return
 
-        if not os.path.exists(chunk_dir):
-            os.makedirs(chunk_dir)
+        if not ResumableMd5.available:
+            self._write_chunk(chunk, chunk_index, manifest, file_hash, file_ext, expected_digest=expected_digest)
+            return
+        # 其它请求正在推进哈希时不等待，由其或合并时补算本切片
+        with FileHashState(self._get_hash_state_path(file_hash), blocking=False) as hash_state:
+            in_order = hash_state is not None and hash_state.next_index == chunk_index
+            self._write_chunk(chunk, chunk_index, manifest, file_hash, file_ext,
+                              hash_state.update if in_order else None, expected_digest)
+            if in_order:
+                hash_state.next_index += 1
+            if hash_state is not None:
+                self._advance_file_hash(hash_state, manifest, file_hash, file_ext)
 
-        with open(chunk_path, 'wb') as f:
-            for chunk_data in chunk.chunks():
-                f.write(chunk_data)
+    def _is_in_tmp_upload_root(self, chunk: UploadedFile) -> bool:
+        if not hasattr(chunk, 'temporary_file_path'):
+            return False
+        return os.path.dirname(os.path.abspath(chunk.temporary_file_path())) == os.path.abspath(TMP_UPLOAD_ROOT)
+
+    def _write_chunk(self, chunk: UploadedFile, chunk_index: int, manifest: UploadManifest, file_hash: str,
+                     file_ext: str, on_data=None, expected_digest: bytes = None) -> None:
+        """
+        写入切片并登记到清单，同时计算切片的MD5
+
+        切片内容与expected_digest不一致时抛出ValueError，在整个文件的增量哈希中计入本切片的操作也随之放弃
+        """
+        chunk_md5 = hashlib.md5()
+
+        def feed(data):
+            chunk_md5.update(data)
+            if on_data is not None:
+                on_data(data)
+
+        def check_digest():
+            if expected_digest is not None and chunk_md5.digest() != expected_digest:
+                raise ValueError(f'chunk {chunk_index} checksum mismatch')
+
+        if manifest.is_preallocated:
+            try:
+                self._write_chunk_at_offset(chunk, chunk_index, manifest, file_hash, file_ext, feed)
+                check_digest()
+            except (ChunkTruncatedError, ValueError):
+                # 原有内容已被覆盖
+                if manifest.is_received(chunk_index):
+                    manifest.mark_missing(chunk_index)
+                raise
+        else:
+            # 先写入临时文件再重命名，保证切片文件存在时内容一定是完整的
+            chunk_path = self._get_chunk_path(file_hash, chunk_index)
+            if self._is_in_tmp_upload_root(chunk):
+                # 上传时已落盘到同一文件系统，重命名即可，无需再拷贝一次
+                if hasattr(chunk, 'md5') and on_data is None:
+                    # 上传处理器在接收时已计算过MD5
+                    chunk_md5 = chunk.md5
+                else:
+                    for chunk_data in chunk.chunks():
+                        feed(chunk_data)
+                tmp_chunk_path = chunk.temporary_file_path()
+                written = os.path.getsize(tmp_chunk_path)
+            else:
+                tmp_chunk_path = f'{chunk_path}.tmp'
+                written = 0
+                with open(tmp_chunk_path, 'wb') as f:
+                    for chunk_data in chunk.chunks():
+                        f.write(chunk_data)
+                        written += len(chunk_data)
+                        feed(chunk_data)
+            try:
+                if written != chunk.size:
+                    # 直接读取请求体时客户端可能中途断开
+                    raise ChunkTruncatedError(f'chunk {chunk_index} truncated')
+                check_digest()
+            except (IOError, ValueError):
+                os.remove(tmp_chunk_path)
+                raise
+            os.replace(tmp_chunk_path, chunk_path)
+        # 切片数据写完后再登记到清单
+        manifest.mark_received(chunk_index, chunk.size, chunk_md5.digest(), expected_digest is not None)
+
+    def _chunk_digest_on_disk(self, manifest: UploadManifest, file_hash: str, file_ext: str, chunk_index: int):
+        chunk_md5 = hashlib.md5()
+        for data in self._iter_uploaded_chunk_data(manifest, file_hash, file_ext, chunk_index):
+            chunk_md5.update(data)
+        return chunk_md5.digest()
 
-    def verify_should_upload(self, file_hash: str, file_ext: str):
+    def verify_uploaded_chunks(self, manifest: UploadManifest, file_hash: str, file_ext: str, chunk_hashes: dict,
+                               workers: int = 8) -> None:
+        """
+        将已接收的切片与客户端提供的MD5比对，校验失败的切片标记为未上传，续传时客户端只需重新发送这些切片
+
+        接收时已记录MD5的切片直接比对记录值，没有记录的切片在线程池中并行读取磁盘计算
+        :param chunk_hashes: 切片序号到MD5十六进制字符串的映射
+        """
+        pending = []
+        for chunk_index in manifest.received_indexes():
+            expected = chunk_hashes.get(chunk_index)
+            if expected is None or manifest.records[chunk_index][0] == CHUNK_VERIFIED and \
+                    manifest.get_digest(chunk_index) == bytes.fromhex(expected):
+                continue
+            pending.append(chunk_index)
+
+        def verify(chunk_index):
+            digest = manifest.get_digest(chunk_index)
+            if digest is None:
+                digest = self._chunk_digest_on_disk(manifest, file_hash, file_ext, chunk_index)
+            return chunk_index, digest
+
+        failed_indexes = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk_index, digest in executor.map(verify, pending):
+                size = manifest.records[chunk_index][1]
+                if digest == bytes.fromhex(chunk_hashes[chunk_index]):
+                    manifest.mark_received(chunk_index, size, digest, verified=True)
+                    continue
+                logger.warning('chunk %d of %s failed verification', chunk_index, file_hash)
+                failed_indexes.append(chunk_index)
+                manifest.mark_missing(chunk_index)
+                if not manifest.is_preallocated:
+                    os.remove(self._get_chunk_path(file_hash, chunk_index))
+        if failed_indexes and ResumableMd5.available:
+            with FileHashState(self._get_hash_state_path(file_hash)) as hash_state:
+                if hash_state.next_index > min(failed_indexes):
+                    # 损坏的切片已计入整个文件的哈希，只能从头计算
+                    hash_state.reset()
+
+    def verify_should_upload(self, file_hash: str, file_ext: str, total_size: int = None, chunk_size: int = None,
+                             compact: bool = False, chunk_hashes: dict = None):
+        """
+        :param total_size: 可选，客户端声明的文件总大小，与chunk_size同时提供时开启偏移写入模式
+        :param chunk_size: 可选，客户端声明的切片大小
+        :param compact: 为True时只返回已上传和缺失切片的区间，不再返回完整的切片名称列表
+        :param chunk_hashes: 可选，切片序号到切片MD5的映射，提供时只返回校验通过的切片
+        """
         file_path = os.path.join(TMP_UPLOAD_ROOT, f"{file_hash}{file_ext}")
         if os.path.exists(file_path):
             return {
                 'shouldUpload': False
             }
         else:
-            uploaded_chunk_list = self.get_uploaded_chunk_list(file_hash)
-            return {
+            # 已经按切片目录方式上传过的文件继续使用原方式
+            if total_size and chunk_size and hasattr(os, 'pwrite') and not os.path.exists(self._get_chunk_dir(file_hash)):
+                self.init_preallocated_upload(file_hash, file_ext, total_size, chunk_size)
+            manifest = self._load_manifest(file_hash)
+            if manifest is None:
+                uploaded_indexes = []
+            elif chunk_hashes:
+                self.verify_uploaded_chunks(manifest, file_hash, file_ext, chunk_hashes)
+                uploaded_indexes = manifest.verified_indexes()
+            else:
+                uploaded_indexes = manifest.received_indexes()
+            res = {
                 'shouldUpload': True,
-                'uploadedList': uploaded_chunk_list
+                'uploadedRanges': to_ranges(uploaded_indexes)
             }
+            if manifest is not None and manifest.is_preallocated:
+                uploaded = set(uploaded_indexes)
+                res['missingRanges'] = to_ranges([i for i in range(manifest.chunk_count) if i not in uploaded])
+            if not compact:
+                res['uploadedList'] = [f'{file_hash}-{index}' for index in uploaded_indexes]
+            return res
@@ -0,0 +1,102 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# hashlib的哈希对象无法序列化，为了在多次请求之间保存MD5的中间状态，直接调用libcrypto的MD5_*接口，
+# 其上下文MD5_CTX是一段普通内存，可以原样保存到文件后再恢复
+_MD5_CTX_SIZE = 128  # MD5_CTX实际为92字节，预留部分空间
+_libcrypto_name = ctypes.util.find_library('crypto')
+try:
+    _libcrypto = ctypes.CDLL(_libcrypto_name) if _libcrypto_name else None
+    _libcrypto.MD5_Init
+except (OSError, AttributeError):
+    _libcrypto = None
+
+# 哈希状态文件的文件头，依次为下一个待计算的切片序号和已计算的字节数
+HASH_STATE_HEADER = struct.Struct('<QQ')
+
+
+class ResumableMd5:
+    """可以保存和恢复中间状态的MD5"""
+    available = _libcrypto is not None and fcntl is not None
+
+    def __init__(self, state: bytes = None):
+        if not self.available:
+            raise RuntimeError('libcrypto is not available')
+        if state is None:
+            self._ctx = ctypes.create_string_buffer(_MD5_CTX_SIZE)
+            _libcrypto.MD5_Init(self._ctx)
+        else:
+            self._ctx = ctypes.create_string_buffer(state, _MD5_CTX_SIZE)
+
+    def update(self, data: bytes) -> None:
+        _libcrypto.MD5_Update(self._ctx, bytes(data), ctypes.c_size_t(len(data)))
+
+    def hexdigest(self) -> str:
+        # MD5_Final会破坏上下文，因此在副本上计算
+        ctx = ctypes.create_string_buffer(self._ctx.raw, _MD5_CTX_SIZE)
+        digest = ctypes.create_string_buffer(16)
+        _libcrypto.MD5_Final(digest, ctx)
+        return digest.raw.hex()
+
+    def to_bytes(self) -> bytes:
+        return self._ctx.raw
+
+
+class FileHashState:
+    """
+    上传过程中整个文件的增量哈希状态
+
+    切片按序到达时即更新哈希，状态保存在文件中以便跨请求、跨进程使用，
+    通过文件锁保证同一时刻只有一个请求在推进状态
+    """
+
+    def __init__(self, state_path: str, blocking: bool = True):
+        self.state_path = state_path
+        self.blocking = blocking
+        self.next_index = 0
+        self.hashed_size = 0
+        self.md5 = None
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._fd)
+            self._fd = None
+            return None
+        data = os.pread(self._fd, HASH_STATE_HEADER.size + _MD5_CTX_SIZE, 0)
+        if len(data) == HASH_STATE_HEADER.size + _MD5_CTX_SIZE:
+            self.next_index, self.hashed_size = HASH_STATE_HEADER.unpack_from(data)
+            self.md5 = ResumableMd5(data[HASH_STATE_HEADER.size:])
+        else:
+            self.md5 = ResumableMd5()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._fd is None:
+            return
+        try:
+            if exc_type is None:
+                # 状态为定长记录，原位覆盖即可
+                os.pwrite(self._fd, HASH_STATE_HEADER.pack(self.next_index, self.hashed_size) + self.md5.to_bytes(), 0)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def update(self, data: bytes) -> None:
+        self.md5.update(data)
+        self.hashed_size += len(data)
+
+    def reset(self) -> None:
+        self.next_index = 0
+        self.hashed_size = 0
+        self.md5 = ResumableMd5()
@@ -0,0 +1,134 @@
+import logging
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Collection
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TMP_UPLOAD_ROOT = settings.TMP_UPLOAD_ROOT
+# 超过此时长未写入的上传视为已放弃，单位秒
+UPLOAD_GC_MAX_AGE = getattr(settings, 'UPLOAD_GC_MAX_AGE', 7 * 24 * 3600)
+# 临时目录允许占用的最大字节数，超出时按最近写入时间从旧到新淘汰
+UPLOAD_GC_BYTE_BUDGET = getattr(settings, 'UPLOAD_GC_BYTE_BUDGET', 200 * 1024 * 1024 * 1024)
+# 最近此时长内仍有写入的上传视为正在进行，任何情况下都不会被清理，单位秒
+UPLOAD_GC_ACTIVE_WINDOW = getattr(settings, 'UPLOAD_GC_ACTIVE_WINDOW', 2 * 3600)
+
+# 临时目录下属于同一次上传的文件，见MultipartFileUploadService
+_UPLOAD_ENTRY_PATTERNS = [
+    re.compile(r'^chunkDir_(?P<hash>\w+)$'),
+    re.compile(r'^manifest_(?P<hash>\w+)$'),
+    re.compile(r'^hashState_(?P<hash>\w+)$'),
+    re.compile(r'^(?P<hash>\w+)\.\w+\.part$'),
+    re.compile(r'^(?P<hash>\w+)\.\w+$'),
+    # ChunkTemporaryUploadedFile落盘的切片，正常情况下写入切片时被重命名，worker中途退出时会残留，
+    # 不属于任何fileHash，每个文件单独按写入时间清理
+    re.compile(r'^(?P<hash>tmp\w+)\.upload\.tmp$'),
+]
+
+
+class UploadEntry:
+    """临时目录中属于同一个fileHash的所有文件"""
+
+    def __init__(self, file_hash: str):
+        self.file_hash = file_hash
+        self.paths = []
+        self.size = 0
+        self.last_write = 0.0
+        self.manifest_mtime = None
+
+    @property
+    def last_active(self) -> float:
+        # 清单在每个切片写入后更新，以其修改时间作为上传最后活跃的时间
+        return self.manifest_mtime if self.manifest_mtime is not None else self.last_write
+
+
+def _scan_entry(entry: UploadEntry) -> UploadEntry:
+    for path in entry.paths:
+        stack = [path]
+        while stack:
+            current = stack.pop()
+            try:
+                stat = os.stat(current)
+            except FileNotFoundError:
+                continue
+            entry.last_write = max(entry.last_write, stat.st_mtime)
+            if os.path.isdir(current):
+                with os.scandir(current) as it:
+                    stack.extend(child.path for child in it)
+            else:
+                entry.size += stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+                if os.path.basename(current).startswith('manifest_'):
+                    entry.manifest_mtime = stat.st_mtime
+    return entry
+
+
+def scan_uploads(root: str = TMP_UPLOAD_ROOT, workers: int = 8):
+    """并行扫描临时目录，按fileHash汇总每次上传占用的空间和最后写入时间"""
+    entries = {}
+    if not os.path.exists(root):
+        return []
+    with os.scandir(root) as it:
+        for dir_entry in it:
+            for pattern in _UPLOAD_ENTRY_PATTERNS:
+                match = pattern.match(dir_entry.name)
+                if match:
+                    file_hash = match.group('hash')
+                    entries.setdefault(file_hash, UploadEntry(file_hash)).paths.append(dir_entry.path)
+                    break
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_scan_entry, entries.values()))
+
+
+def _remove_entry(entry: UploadEntry) -> None:
+    for path in entry.paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def sweep_uploads(max_age: int = UPLOAD_GC_MAX_AGE, byte_budget: int = UPLOAD_GC_BYTE_BUDGET,
+                  active_window: int = UPLOAD_GC_ACTIVE_WINDOW, root: str = TMP_UPLOAD_ROOT, workers: int = 8,
+                  dry_run: bool = False, keep_hashes: Collection[str] = ()):
+    """
+    清理临时目录中被放弃的上传
+
+    先清理超过max_age未写入的上传，若剩余占用仍超出byte_budget，再按最近写入时间从旧到新淘汰，
+    active_window内仍有写入的上传始终保留
+    :param keep_hashes: 始终保留的fileHash，如已上传完成、等待入库任务合并的上传
+    :return: 清理结果统计
+    """
+    now = time.time()
+    entries = sorted(scan_uploads(root, workers), key=lambda e: e.last_active)
+    total_size = sum(entry.size for entry in entries)
+    remaining_size = total_size
+    evicted = []
+    for entry in entries:
+        if now - entry.last_active < active_window:
+            # 按时间排序，之后的上传都仍在进行
+            break
+        if entry.file_hash in keep_hashes:
+            continue
+        if now - entry.last_active < max_age and remaining_size <= byte_budget:
+            continue
+        evicted.append(entry)
+        remaining_size -= entry.size
+
+    reclaimed_size = 0
+    for entry in evicted:
+        logger.info('evict upload %s, %d bytes, last active at %s', entry.file_hash, entry.size,
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.last_active)))
+        if not dry_run:
+            _remove_entry(entry)
+        reclaimed_size += entry.size
+    return {
+        'scanned': len(entries),
+        'evicted': len(evicted),
+        'totalBytes': total_size,
+        'reclaimedBytes': reclaimed_size,
+    }
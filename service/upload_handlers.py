@@ -0,0 +1,60 @@
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, TemporaryFileUploadHandler
+
+TMP_UPLOAD_ROOT = settings.TMP_UPLOAD_ROOT
+IO_SIZE = 1024 * 1024  # 每次IO操作1mb数据
+
+
+class ChunkTemporaryUploadedFile(TemporaryUploadedFile):
+    """
+    落盘到TMP_UPLOAD_ROOT而不是系统临时目录的上传文件
+
+    与切片目录位于同一文件系统，写入切片时直接重命名即可，不必再拷贝一次
+    """
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        if not os.path.exists(TMP_UPLOAD_ROOT):
+            os.makedirs(TMP_UPLOAD_ROOT, exist_ok=True)
+        file = tempfile.NamedTemporaryFile(suffix='.upload.tmp', dir=TMP_UPLOAD_ROOT)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+
+
+class ChunkTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """将较大的切片直接写入TMP_UPLOAD_ROOT的上传处理器，避免占用/tmp"""
+
+    def new_file(self, *args, **kwargs):
+        FileUploadHandler.new_file(self, *args, **kwargs)
+        self.file = ChunkTemporaryUploadedFile(self.file_name, self.content_type, 0, self.charset,
+                                               self.content_type_extra)
+        # 接收的同时计算切片MD5，写入切片时无需再读取一遍
+        self.file.md5 = hashlib.md5()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.md5.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+
+class RequestBodyChunk:
+    """
+    将application/octet-stream请求体包装为切片
+
+    提供与UploadedFile相同的size和chunks()，读取请求体的同时写入目标位置，请求体不会先落盘
+    """
+
+    def __init__(self, stream, size: int):
+        self.stream = stream
+        self.size = size
+
+    def chunks(self, chunk_size: int = IO_SIZE):
+        remaining = self.size
+        while remaining > 0:
+            data = self.stream.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
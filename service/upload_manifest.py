@@ -0,0 +1,125 @@
+import os
+import struct
+from typing import List, Optional, Tuple
+
+# 文件头，依次为文件总大小和切片大小，按切片目录方式上传时二者均为0，表示未知
+MANIFEST_HEADER = struct.Struct('<QQ')
+# 每个切片对应一条定长记录，依次为切片状态、切片大小和切片内容的MD5，记录位置由切片序号决定
+MANIFEST_RECORD = struct.Struct('<BQ16s')
+
+# 切片状态
+CHUNK_MISSING = 0
+CHUNK_RECEIVED = 1  # 已接收，尚未与客户端提供的校验值比对
+CHUNK_VERIFIED = 2  # 已接收且校验通过
+_EMPTY_RECORD = (CHUNK_MISSING, 0, bytes(16))
+
+
+class UploadManifest:
+    """
+    单次上传的切片清单
+
+    清单是一个紧凑的二进制文件，每个切片的记录位于固定偏移量，
+    写入一个切片的状态只需一次写入，并发上传不同切片时互不影响，也无需加锁；
+    查询上传进度时只需读取这一个小文件，不必列出切片目录
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.total_size = 0
+        self.chunk_size = 0
+        # 每个元素为(切片状态, 切片大小, 切片MD5)
+        self.records: List[Tuple[int, int, bytes]] = []
+
+    @classmethod
+    def create(cls, path: str, total_size: int = 0, chunk_size: int = 0) -> 'UploadManifest':
+        manifest = cls(path)
+        manifest.total_size, manifest.chunk_size = total_size, chunk_size
+        manifest.records = [_EMPTY_RECORD] * manifest.chunk_count
+        with open(path, 'wb') as f:
+            f.write(MANIFEST_HEADER.pack(total_size, chunk_size) + MANIFEST_RECORD.pack(*_EMPTY_RECORD) * manifest.chunk_count)
+        return manifest
+
+    @classmethod
+    def ensure(cls, path: str) -> 'UploadManifest':
+        """切片目录方式下获取清单，不存在时创建，多个请求同时创建时只有一个生效"""
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            return cls.load(path)
+        with open(path, 'r+b') as f:
+            f.write(MANIFEST_HEADER.pack(0, 0))
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['UploadManifest']:
+        """清单不存在时返回None"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        manifest = cls(path)
+        if len(data) < MANIFEST_HEADER.size:
+            # 其它请求刚刚创建清单，尚未写入文件头
+            return manifest
+        manifest.total_size, manifest.chunk_size = MANIFEST_HEADER.unpack_from(data)
+        # 切片目录方式下清单随切片序号增长，末尾可能存在尚未写完的记录，忽略即可
+        record_count = (len(data) - MANIFEST_HEADER.size) // MANIFEST_RECORD.size
+        manifest.records = [MANIFEST_RECORD.unpack_from(data, MANIFEST_HEADER.size + i * MANIFEST_RECORD.size)
+                            for i in range(record_count)]
+        return manifest
+
+    @property
+    def is_preallocated(self) -> bool:
+        return self.chunk_size > 0
+
+    @property
+    def chunk_count(self) -> int:
+        if not self.is_preallocated:
+            return len(self.records)
+        return (self.total_size + self.chunk_size - 1) // self.chunk_size
+
+    def is_received(self, chunk_index: int) -> bool:
+        return chunk_index < len(self.records) and self.records[chunk_index][0] != CHUNK_MISSING
+
+    def received_indexes(self) -> List[int]:
+        return [index for index, (state, _, _) in enumerate(self.records) if state != CHUNK_MISSING]
+
+    def verified_indexes(self) -> List[int]:
+        return [index for index, (state, _, _) in enumerate(self.records) if state == CHUNK_VERIFIED]
+
+    def received_size(self) -> int:
+        return sum(size for state, size, _ in self.records if state != CHUNK_MISSING)
+
+    def missing_count(self) -> int:
+        return self.chunk_count - len(self.received_indexes())
+
+    def get_digest(self, chunk_index: int) -> Optional[bytes]:
+        """切片的MD5，清单功能上线前接收的切片没有记录MD5，返回None"""
+        digest = self.records[chunk_index][2]
+        return digest if any(digest) else None
+
+    def _write_record(self, chunk_index: int, record: Tuple[int, int, bytes]) -> None:
+        with open(self.path, 'r+b') as f:
+            f.seek(MANIFEST_HEADER.size + chunk_index * MANIFEST_RECORD.size)
+            f.write(MANIFEST_RECORD.pack(*record))
+        if chunk_index >= len(self.records):
+            self.records.extend([_EMPTY_RECORD] * (chunk_index + 1 - len(self.records)))
+        self.records[chunk_index] = record
+
+    def mark_received(self, chunk_index: int, size: int, digest: bytes = bytes(16), verified: bool = False) -> None:
+        self._write_record(chunk_index, (CHUNK_VERIFIED if verified else CHUNK_RECEIVED, size, digest))
+
+    def mark_missing(self, chunk_index: int) -> None:
+        self._write_record(chunk_index, _EMPTY_RECORD)
+
+
+def to_ranges(indexes: List[int]) -> List[List[int]]:
+    """将有序的切片序号压缩为闭区间列表，如[0, 1, 2, 5] -> [[0, 2], [5, 5]]"""
+    ranges = []
+    for index in indexes:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
@@ -0,0 +1,35 @@
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+
+_redis_client = None
+
+
+def get_redis():
+    """与celery共用同一个redis实例"""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(settings.BROKER_URL)
+    return _redis_client
+
+
+@contextmanager
+def redis_lock(name: str, timeout: int = 6 * 3600, blocking: bool = False, blocking_timeout: float = None):
+    """
+    跨进程、跨节点的互斥锁
+
+    获取成功时返回True，blocking为False且锁已被占用时返回False；
+    持有者异常退出时锁在timeout秒后自动释放
+    """
+    lock = get_redis().lock(f'lock:{name}', timeout=timeout)
+    acquired = lock.acquire(blocking=blocking, blocking_timeout=blocking_timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                # 超时后锁已被自动释放
+                pass
@@ -83,6 +83,23 @@ class VideoSerializer(serializers.ModelSerializer):
                                         help_text='列表格式')
     metadata = serializers.JSONField(label='补充信息', help_text='内容包括视频分段信息等', default=dict)  # 添加metadata字段
     surgery_info = serializers.JSONField(label='手术信息', help_text='受术者信息和手术简介等，主要用于精选视频', default=dict)
+    jobStatus = serializers.SerializerMethodField(label='后台处理任务状态',
+                                                  help_text='合并、转码等后台任务的进度，包括阶段stage和错误信息error')
+
+    hlsUrl = serializers.SerializerMethodField(label='HLS播放地址',
+                                               help_text='与videoUrl的DASH共用分片的HLS主播放列表，供不支持DASH的客户端(如iOS)播放')
+
+    thumbnailsUrl = serializers.SerializerMethodField(label='进度条预览缩略图',
+                                                      help_text='WebVTT格式的缩略图索引，每条cue指向雪碧图中的一块区域(#xywh)，供拖动进度条时预览')
+
+    def get_jobStatus(self, obj):
+        return (obj.metadata or {}).get('job')
+
+    def get_hlsUrl(self, obj):
+        return FileUrlField().to_representation((obj.metadata or {}).get('hlsUrl'))
+
+    def get_thumbnailsUrl(self, obj):
+        return FileUrlField().to_representation((obj.metadata or {}).get('thumbnailsUrl'))
 
     class Meta:
         model = Video